@@ -0,0 +1,366 @@
+import os
+import io
+import queue
+import collections
+import traceback
+import concurrent.futures
+import multiprocessing
+
+import pandas as pd
+
+from instrumentation import PhaseRecorder, count_edited_cells, file_metrics, optional_profile
+from parallel import PARALLEL_TRANSFORM_MIN_ROWS, map_isolated, transform_dataframe_parallel
+from patching import PatchNotSupported, patch_workbook
+from processing import (DIFF_CELL_LIMIT, cell_changes, compute_column_widths, index_to_excel_col, to_arrow_frame,
+                        to_numpy_frame, transform_dataframe, write_workbook, write_workbook_sheets)
+from streaming import STREAMING_ROW_THRESHOLD, estimate_row_count, scan_workbook, stream_transform_workbook
+from tables import TABLE_EXTENSIONS, is_table_file, read_table_bytes, write_table_bytes
+
+# Per-file batch execution shared by the Streamlit app and headless tooling.
+# process_file() is pure (bytes in, bytes + stats out) so it can run in a worker process.
+
+DEFAULT_MAX_WORKERS = os.cpu_count() or 1
+
+# 'auto' streams .xlsx files above STREAMING_ROW_THRESHOLD rows, 'memory' never streams
+PROCESSING_MODES = ('auto', 'memory', 'streaming')
+# 'rewrite' regenerates the workbook; 'patch' edits only the changed cells of the uploaded
+# .xlsx (keeping its formatting and other sheets) and falls back to 'rewrite' when it can't
+OUTPUT_MODES = ('rewrite', 'patch')
+# Inputs: Excel workbooks and the tables.TABLE_EXTENSIONS (Parquet, CSV)
+INPUT_EXTENSIONS = ('.xlsx', '.xls') + TABLE_EXTENSIONS
+
+# trace_memory records a tracemalloc peak per phase (slow); profile captures a cProfile of the file;
+# dtype_backend 'pyarrow' transforms in-memory sheets on Arrow dtypes (processing.DTYPE_BACKENDS);
+# transform_workers > 1 spreads the transform of large in-memory sheets over that many processes;
+# output_format is one of tables.OUTPUT_FORMATS (Parquet/CSV outputs are never streamed or patched);
+# sheets is None for the first worksheet only, 'all', or a tuple of worksheet names (see process_sheets)
+ProcessOptions = collections.namedtuple(
+    'ProcessOptions', ['mode', 'fit_widths', 'output_mode', 'trace_memory', 'profile', 'dtype_backend',
+                       'transform_workers', 'output_format', 'sheets'],
+    defaults=['auto', True, 'rewrite', False, False, 'numpy', 1, 'xlsx', None])
+DEFAULT_OPTIONS = ProcessOptions()
+
+# status is 'processed', 'unchanged', 'error' or 'cancelled'; output is None unless processed;
+# metrics is an instrumentation.FileMetrics, or None for cached, cancelled and crashed-worker results;
+# changed_cells counts the cells whose value changed and diff holds the first of them (processing.CellChange);
+# sheets holds a SheetResult per worksheet when several are processed; cached marks results served from the cache
+FileResult = collections.namedtuple(
+    'FileResult', ['name', 'status', 'output', 'shape', 'message', 'error_detail', 'metrics', 'changed_cells', 'diff',
+                   'sheets', 'cached'],
+    defaults=[None, 0, (), (), False])
+# status is 'processed', 'unchanged' or 'error'; shape is (rows, cols)
+SheetResult = collections.namedtuple('SheetResult', ['name', 'status', 'shape', 'changed_cells', 'message'])
+
+
+# How often the batch loop drains worker progress and checks for cancellation
+PROGRESS_POLL_SECONDS = 0.25
+
+
+class BatchCancelled(Exception):
+    """Raised by a progress callback to stop the current file at its next checkpoint."""
+
+
+def read_uploaded_excel(name, data):
+    return pd.read_excel(io.BytesIO(data), engine='openpyxl' if name.lower().endswith('.xlsx') else 'xlrd', header=0)
+
+
+def read_uploaded_sheet(name, data):
+    return read_table_bytes(name, data) if is_table_file(name) else read_uploaded_excel(name, data)
+
+
+def use_streaming(name, data, mode='auto'):
+    """(whether to stream, data row count from the sheet's dimension record or None)."""
+    if not name.lower().endswith('.xlsx') or mode == 'memory': return False, None
+    row_count = estimate_row_count(data)
+    return mode == 'streaming' or (row_count is not None and row_count > STREAMING_ROW_THRESHOLD), row_count
+
+
+def process_file(name, data, options=DEFAULT_OPTIONS, progress=None):
+    """progress(fraction) is called at every checkpoint (each streamed chunk, each in-memory phase)
+    and may raise BatchCancelled to abandon the file."""
+    recorder = PhaseRecorder(options.trace_memory)
+    with optional_profile(options.profile) as profiler:
+        result = _process_file(name, data, options, recorder, progress or (lambda fraction: None))
+    return result._replace(metrics=file_metrics(recorder, profiler))
+
+
+def _process_file(name, data, options, recorder, progress):
+    current_df_shape = (0, 0)
+    try:
+        progress(0.0)
+        if options.sheets is not None and not is_table_file(name):
+            return process_sheets(name, data, options, recorder, progress)
+        stream, estimated_rows = use_streaming(name, data, options.mode) if options.output_format == 'xlsx' \
+            else (False, None)
+        if stream:
+            # The scan takes the first half of the progress range, measured against the dimension's row count
+            scan_fraction = (lambda rows_scanned: min(rows_scanned / estimated_rows, 1.0)) if estimated_rows \
+                else (lambda rows_scanned: 0.0)
+            with recorder.phase('scan') as phase:
+                scan = scan_workbook(data, progress=lambda rows_scanned: progress(0.5 * scan_fraction(rows_scanned)))
+                phase['rows'] = scan.n_rows
+            current_df_shape = (scan.n_rows, len(scan.columns))
+            edits, diff = [], []
+            with recorder.phase('stream', scan.n_rows) as phase:
+                output, file_was_modified = stream_transform_workbook(
+                    data, scan, fit_widths=options.fit_widths, edits=edits, diff=diff,
+                    progress=lambda fraction: progress(0.5 + 0.5 * fraction))
+                phase['cells_written'] = count_edited_cells(edits)
+            if not file_was_modified:
+                return FileResult(name, 'unchanged', None, current_df_shape, "", "")
+            return FileResult(name, 'processed', output, current_df_shape, "", "",
+                              changed_cells=count_edited_cells(edits), diff=tuple(diff))
+
+        with recorder.phase('read') as phase:
+            df_original = read_uploaded_sheet(name, data)
+            phase['rows'] = len(df_original)
+        current_df_shape = df_original.shape
+        progress(0.3)
+        n_rows, edits = len(df_original), []
+        if options.dtype_backend == 'pyarrow':
+            with recorder.phase('to arrow', n_rows):
+                df_original = to_arrow_frame(df_original)
+        with recorder.phase('transform', n_rows) as phase:
+            if options.transform_workers > 1 and n_rows >= PARALLEL_TRANSFORM_MIN_ROWS:
+                df_processed, file_was_modified = transform_dataframe_parallel(
+                    df_original, options.transform_workers, edits)
+            else:
+                df_processed, file_was_modified = transform_dataframe(df_original, edits)
+            phase['cells_written'] = count_edited_cells(edits)
+        # Parquet/CSV outputs are written from Arrow columns as they are
+        if file_was_modified and options.dtype_backend == 'pyarrow' and options.output_format == 'xlsx':
+            with recorder.phase('to numpy', n_rows):
+                df_processed = to_numpy_frame(df_processed)
+        if not file_was_modified:
+            return FileResult(name, 'unchanged', None, current_df_shape, "", "")
+        diff = tuple(cell_changes(df_original, df_processed, edits))
+        progress(0.6)
+        output = None
+        if options.output_format != 'xlsx':
+            with recorder.phase('serialize', n_rows) as phase:
+                output = write_table_bytes(df_processed, options.output_format)
+                phase['cells_written'] = df_processed.size
+        elif options.output_mode == 'patch' and name.lower().endswith('.xlsx'):
+            with recorder.phase('patch', n_rows) as phase:
+                try:
+                    output = patch_workbook(data, df_processed, edits)
+                    phase['cells_written'] = count_edited_cells(edits)
+                except PatchNotSupported:
+                    output = None
+        if output is None:
+            widths = None
+            if options.fit_widths:
+                with recorder.phase('widths', n_rows):
+                    widths = compute_column_widths(df_processed)
+            with recorder.phase('serialize', n_rows) as phase:
+                output = write_workbook(df_processed, options.fit_widths, widths)
+                phase['cells_written'] = df_processed.size
+        return FileResult(name, 'processed', output, current_df_shape, "", "", changed_cells=count_edited_cells(edits),
+                          diff=diff)
+    except BatchCancelled:
+        return FileResult(name, 'cancelled', None, current_df_shape, f"Cancelled {name}", "")
+    except IndexError as e_idx:
+        return FileResult(name, 'error', None, current_df_shape, _index_error_message(name, e_idx, current_df_shape), "")
+    except Exception as e:
+        return FileResult(name, 'error', None, current_df_shape,
+                          f"Error processing {name}: {e}", traceback.format_exc())
+
+
+def _index_error_message(name, e_idx, shape):
+    idx_arg = e_idx.args[0] if e_idx.args else -1
+    col_letter_involved = index_to_excel_col(idx_arg if isinstance(idx_arg, int) else -1)
+    return f"Index Error in {name}: {e_idx}. Problem with col {col_letter_involved}. File has {shape[1]} cols."
+
+
+# --- Several worksheets per workbook ---
+def transform_sheet(df_original, dtype_backend='numpy', to_numpy=True):
+    """transform_dataframe for one worksheet: (df_processed, modified, changed cells, first CellChanges)."""
+    edits = []
+    frame = to_arrow_frame(df_original) if dtype_backend == 'pyarrow' else df_original
+    df_processed, modified = transform_dataframe(frame, edits)
+    if dtype_backend == 'pyarrow' and to_numpy: df_processed = to_numpy_frame(df_processed)
+    return df_processed, modified, count_edited_cells(edits), cell_changes(frame, df_processed, edits)
+
+
+def process_sheets(name, data, options, recorder, progress):
+    """All (or the selected) worksheets, each transformed on its own, into one workbook in the original order.
+
+    Sheets that aren't selected, and sheets that fail, are written back unchanged; failures are
+    reported in FileResult.sheets. The file is 'processed' if any sheet changed and 'error' only if
+    nothing changed and a sheet failed. Always a rewrite: patching and streaming handle the first
+    sheet only. Parquet/CSV output holds the one selected sheet alone.
+    """
+    with recorder.phase('read') as phase:
+        with pd.ExcelFile(io.BytesIO(data), engine='openpyxl' if name.lower().endswith('.xlsx') else 'xlrd') as workbook:
+            missing = [] if options.sheets == 'all' else [s for s in options.sheets if s not in workbook.sheet_names]
+            if missing: raise ValueError(f"no worksheet named {', '.join(map(repr, missing))}")
+            sheet_names = [s for s in workbook.sheet_names if options.sheets == 'all' or s in options.sheets]
+            kept_names = workbook.sheet_names if options.output_format == 'xlsx' else sheet_names
+            # One load of the workbook for all sheets
+            all_frames = {s: workbook.parse(s, header=0) for s in kept_names}
+        frames = [all_frames[s] for s in sheet_names]
+        phase['rows'] = sum(len(df) for df in frames)
+    if options.output_format != 'xlsx' and len(frames) > 1:
+        raise ValueError(f"{len(frames)} worksheets need Excel output, not {options.output_format}")
+    total_rows = phase['rows']
+    progress(0.3)
+
+    with recorder.phase('transform', total_rows) as phase:
+        # Small workbooks stay in this process: spawning workers would cost more than the transforms
+        workers = options.transform_workers if total_rows >= PARALLEL_TRANSFORM_MIN_ROWS else 1
+        outcomes = map_isolated(transform_sheet, [(df, options.dtype_backend, options.output_format == 'xlsx')
+                                                  for df in frames], workers)
+        sheet_results, written, diff = [], dict(all_frames), []
+        for sheet_name, df_original, (outcome, error) in zip(sheet_names, frames, outcomes):
+            if error is not None:
+                message = _index_error_message(f"{name} [{sheet_name}]", error, df_original.shape) \
+                    if isinstance(error, IndexError) else f"Error processing {name} [{sheet_name}]: {error}"
+                sheet_results.append(SheetResult(sheet_name, 'error', df_original.shape, 0, message)); continue
+            df_processed, modified, changed_cells, changes = outcome
+            sheet_results.append(SheetResult(sheet_name, 'processed' if modified else 'unchanged', df_original.shape,
+                                             changed_cells, ""))
+            written[sheet_name] = df_processed
+            diff.extend(c._replace(cell=f"{sheet_name}!{c.cell}") for c in changes[:DIFF_CELL_LIMIT - len(diff)])
+        changed_cells = sum(r.changed_cells for r in sheet_results)
+        phase['cells_written'] = changed_cells
+    shape = (total_rows, max((df.shape[1] for df in frames), default=0))
+    errors = [r.message for r in sheet_results if r.status == 'error']
+    if not any(r.status == 'processed' for r in sheet_results):
+        status = 'error' if errors else 'unchanged'
+        return FileResult(name, status, None, shape, "; ".join(errors), "", sheets=tuple(sheet_results))
+    progress(0.6)
+
+    with recorder.phase('serialize', total_rows) as phase:
+        if options.output_format != 'xlsx':
+            output = write_table_bytes(written[sheet_names[0]], options.output_format)
+        else:
+            output = write_workbook_sheets([(s, df, None) for s, df in written.items()], options.fit_widths)
+        phase['cells_written'] = sum(df.size for df in written.values())
+    return FileResult(name, 'processed', output, shape, "; ".join(errors), "", changed_cells=changed_cells,
+                      diff=tuple(diff), sheets=tuple(sheet_results))
+
+
+def process_path(path, options=DEFAULT_OPTIONS, progress=None):
+    name = os.path.basename(path)
+    try:
+        with open(path, 'rb') as f: data = f.read()
+    except OSError as e:
+        return FileResult(name, 'error', None, (0, 0), f"Error processing {name}: {e}", "")
+    return process_file(name, data, options, progress)
+
+
+def run_batch(files, max_workers=DEFAULT_MAX_WORKERS, on_result=None, worker=process_file, keep_outputs=True,
+              cache=None, on_progress=None, cancel_event=None):
+    """Run worker(*args) for each args tuple in files; results come back in input order.
+
+    files holds argument tuples: (name, bytes[, options]) for process_file, or
+    (path[, options]) for process_path.
+    on_result(done_count, result) is called as each file finishes, in completion order.
+    With keep_outputs=False the output bytes are dropped once on_result has handled them.
+    cache is an optional cache.ResultCache consulted before running process_file arguments;
+    hits are reported first and fresh results are stored back into it.
+    on_progress(file_index, fraction) reports progress within files, from the calling thread.
+    Setting cancel_event (a threading.Event) stops running files at their next checkpoint;
+    they and any files not yet started come back with status 'cancelled'.
+    """
+    results = [None] * len(files)
+    done_count = 0
+
+    def finish(i, result, from_cache=False):
+        nonlocal done_count
+        done_count += 1
+        if cache is not None and not from_cache: cache.put(files[i][1], _file_options(files[i]), result)
+        if on_progress: on_progress(i, 1.0)
+        if on_result: on_result(done_count, result)
+        results[i] = result if keep_outputs else result._replace(output=None)
+
+    def cancelled_result(i):
+        name = os.path.basename(files[i][0])
+        return FileResult(name, 'cancelled', None, (0, 0), f"Cancelled {name}", "")
+
+    def is_cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    pending = []
+    for i, args in enumerate(files):
+        use_cache = cache is not None and not _file_options(args).profile  # a profile needs a real run
+        cached = cache.get(args[0], args[1], _file_options(args)) if use_cache else None
+        if cached is not None:
+            finish(i, cached, from_cache=True)
+        else:
+            pending.append(i)
+
+    if max_workers <= 1 or len(pending) <= 1:
+        for i in pending:
+            if is_cancelled():
+                finish(i, cancelled_result(i)); continue
+
+            def progress(fraction, i=i):
+                if is_cancelled(): raise BatchCancelled()
+                if on_progress: on_progress(i, fraction)
+            finish(i, worker(*files[i], progress=progress))
+        return results
+
+    # spawn keeps workers independent of the (multi-threaded) server process
+    mp_context = multiprocessing.get_context('spawn')
+    progress_queue, worker_cancel_event = mp_context.Queue(), mp_context.Event()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(max_workers, len(pending)), mp_context=mp_context,
+            initializer=_init_worker, initargs=(progress_queue, worker_cancel_event)) as pool:
+        futures = {pool.submit(_run_in_worker, worker, i, files[i]): i for i in pending}
+        not_done = set(futures)
+        while not_done:
+            done, not_done = concurrent.futures.wait(
+                not_done, timeout=PROGRESS_POLL_SECONDS, return_when=concurrent.futures.FIRST_COMPLETED)
+            _drain_progress(progress_queue, on_progress)
+            if is_cancelled() and not worker_cancel_event.is_set():
+                worker_cancel_event.set()
+                for future in not_done: future.cancel()
+            for future in done:
+                i = futures[future]
+                if future.cancelled():
+                    finish(i, cancelled_result(i)); continue
+                try:
+                    result = future.result()
+                except Exception as e:  # worker died (e.g. out of memory); isolate it to this file
+                    name = files[i][0]
+                    result = FileResult(name, 'error', None, (0, 0), f"Error processing {name}: {e}",
+                                        traceback.format_exc())
+                finish(i, result)
+    return results
+
+
+def _file_options(args):
+    return args[2] if len(args) > 2 else DEFAULT_OPTIONS
+
+
+def cache_lookup_counts(files, results):
+    """(hits, misses) of a run_batch call that was given a cache."""
+    looked_up = sum(not _file_options(args).profile for args in files)
+    hits = sum(r.cached for r in results)
+    return hits, looked_up - hits
+
+
+# --- Worker-process side of progress and cancellation ---
+_worker_progress_queue = _worker_cancel_event = None
+
+
+def _init_worker(progress_queue, cancel_event):
+    global _worker_progress_queue, _worker_cancel_event
+    _worker_progress_queue, _worker_cancel_event = progress_queue, cancel_event
+
+
+def _run_in_worker(worker, index, args):
+    def progress(fraction):
+        if _worker_cancel_event.is_set(): raise BatchCancelled()
+        _worker_progress_queue.put((index, fraction))
+    return worker(*args, progress=progress)
+
+
+def _drain_progress(progress_queue, on_progress):
+    while True:
+        try:
+            index, fraction = progress_queue.get_nowait()
+        except queue.Empty:
+            return
+        if on_progress: on_progress(index, fraction)
@@ -0,0 +1,397 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import zipfile
+import argparse
+import platform
+import resource
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from batch import ProcessOptions, process_file, read_uploaded_excel
+from instrumentation import PhaseRecorder
+from parallel import transform_dataframe_parallel
+from processing import (
+    DTYPE_BACKENDS, RULES_VERSION, build_lookup_maps, compute_column_widths, index_to_excel_col, parse_filename,
+    parse_filename_cells, to_arrow_frame, to_numpy_frame, transform_chunk, transform_dataframe, write_workbook)
+from rules import DEFAULT_RULES_PATH, excel_col_to_index, load_rule_plan
+from streaming import STREAMING_CHUNK_ROWS, scan_workbook, stream_transform_workbook
+
+# Phase-level benchmark for XL MASTER on synthetic cue sheets, plus an equivalence check of
+# the optimized paths against a reference copy of the original row-by-row rules.
+#   python benchmark.py --rows 1000 10000 --stem-ratio 0.6 --titles 200 -o bench.json
+
+STEM_NAMES = ["LeadVocal", "VocalBackground", "VocalsBackground", "Vox", "DrumsKit", "BassDrum", "Bass",
+              "AcousticGuitar2", "ElectricGuitars", "PercussionLoop", "HiHat", "Piano", "Keys1", "Synth",
+              "Strings", "TubularBells", "FX", "Other"]
+T_VALUES = ["Full, Song, Lyrics, Vocals", "Full, Instrumental", "Instrumental", None]
+
+
+# The reference below is the original code, so it keeps the original fixed layout; the checks
+# are meaningful for the default rules.json, which encodes that layout.
+A_IDX, AE_IDX, C_IDX, E_IDX, K_IDX, P_IDX, S_IDX, T_IDX, U_IDX, V_IDX, Y_IDX, AI_IDX, BC_IDX, BD_IDX = map(
+    excel_col_to_index, ['A', 'AE', 'C', 'E', 'K', 'P', 'S', 'T', 'U', 'V', 'Y', 'AI', 'BC', 'BD'])
+FILENAME_COL_IDX, TRACK_TITLE_COL_IDX = excel_col_to_index('B'), excel_col_to_index('R')
+EXCLUDED_COL_INDICES = sorted(set(map(excel_col_to_index, [
+    'A', 'B', 'C', 'D', 'E', 'K', 'S', 'T', 'U', 'V', 'X', 'Y', 'AE', 'AI', 'AP', 'BC', 'BD'])))
+INSTRUMENT_KEYWORD_MAP = load_rule_plan(DEFAULT_RULES_PATH).instruments.keyword_map
+
+
+# --- Synthetic Workload ---
+def make_workbook_frame(rows, stem_ratio=0.5, title_count=100, seed=0):
+    """A cue sheet laid out like the real ones: columns A..BD, filenames in B, titles in R.
+
+    stem_ratio is the share of filename rows that are _STEM rows (the rest are _Full);
+    stem rows leave R blank so the transform has to fill and copy them.
+    """
+    rng = np.random.default_rng(seed)
+    n_cols = BD_IDX + 1
+    title_ids = rng.integers(title_count, size=rows)
+    titles = [f"Big_Title {t}" if t % 5 == 0 else f"Song Title {t}" for t in title_ids]
+    is_stem = rng.random(rows) < stem_ratio
+    stems = rng.choice(STEM_NAMES, size=rows)
+    no_filename = rng.random(rows) < 0.02
+
+    filenames = [None if blank else f"ALB{t % 1000:03d}_{t % 100:02d}_{title}_{'STEM' + stem if stem_row else 'Full'}.wav"
+                 for t, title, stem, stem_row, blank in zip(title_ids, titles, stems, is_stem, no_filename)]
+    keep_title = ~is_stem | (rng.random(rows) < 0.1)
+    data = {ci: rng.choice(np.array([None, "x", "value", 7, 1.5], dtype=object), size=rows) for ci in range(n_cols)}
+    data[A_IDX] = np.where(rng.random(rows) < 0.9, np.arange(1, rows + 1), None)
+    data[AE_IDX] = data[A_IDX].copy()
+    data[FILENAME_COL_IDX] = np.array(filenames, dtype=object)
+    data[TRACK_TITLE_COL_IDX] = np.where(keep_title, np.array(titles, dtype=object), None)
+    data[P_IDX] = rng.choice(np.array(["PFX", None], dtype=object), size=rows)
+    data[T_IDX] = rng.choice(np.array(T_VALUES, dtype=object), size=rows)
+    data[V_IDX] = np.array([f"{t % 100:02d}" for t in title_ids], dtype=object)
+    data[AI_IDX] = rng.choice(np.array(["Lyrics AI", "Instr AI", None], dtype=object), size=rows)
+    data[BD_IDX] = rng.choice(np.array(["Vocal Lead", "Vocal Choir", None], dtype=object), size=rows)
+    columns = [f"Column {index_to_excel_col(ci)}" for ci in range(n_cols)]
+    return pd.DataFrame({columns[ci]: data[ci] for ci in range(n_cols)})
+
+
+def make_workbook(rows, stem_ratio=0.5, title_count=100, seed=0):
+    return write_workbook(make_workbook_frame(rows, stem_ratio, title_count, seed), fit_widths=False)
+
+
+def make_check_workbook(rows, stem_ratio=0.5, title_count=100, seed=0):
+    """make_workbook plus columns whose type read_excel decides from rows far apart, for the checks.
+
+    P is 7 with blanks in the first quarter only (7.0 everywhere, so C reads '7.0 ...'); AQ is '0'
+    text with one 'x' in the first quarter; AR is numeric with one text cell in the last quarter.
+    """
+    df = make_workbook_frame(rows, stem_ratio, title_count, seed)
+    quarter = max(rows // 4, 1)
+    aq_idx, ar_idx = excel_col_to_index('AQ'), excel_col_to_index('AR')
+    df.iloc[:, P_IDX] = 7
+    df.iloc[:quarter:7, P_IDX] = None
+    df.iloc[:, aq_idx] = "0"
+    df.iloc[min(3, rows - 1), aq_idx] = "x"
+    df.iloc[:, ar_idx] = 5
+    df.iloc[rows - 1 - min(3, rows - 1), ar_idx] = "y"
+    return write_workbook(df, fit_widths=False)
+
+
+# --- Reference Rules (original row-by-row implementation) ---
+def _ref_raw_stem(fn_str):
+    name, _ = os.path.splitext(fn_str)
+    m = re.search(r"_STEM(.*)", name)
+    return m.group(1) if m and m.group(1) else None
+
+
+def _ref_format_stem(stem_raw):
+    if not stem_raw or not isinstance(stem_raw, str): return ""
+    txt = re.sub(r"([a-z\d])([A-Z])", r"\1 \2", stem_raw)
+    txt = re.sub(r"([A-Z])([A-Z][a-z])", r"\1 \2", txt)
+    txt = re.sub(r"([A-Za-z])(\d)", r"\1 \2", txt)
+    return re.sub(r'\s+', ' ', txt).strip()
+
+
+def _ref_title(fn_str):
+    if not fn_str.strip(): return None
+    name = os.path.splitext(fn_str)[0]
+    for suffix in ("_STEM", "_Full"):
+        if suffix in name:
+            name = name.split(suffix)[0]; break
+    parts = name.split('_')
+    if len(parts) >= 3:
+        title = "_".join(parts[2:]); return title.strip() if title else None
+    elif len(parts) == 2:
+        return parts[1].strip() if parts[1] else None
+    return name.strip() or None
+
+
+def _ref_parts(fn_str):
+    return os.path.splitext(fn_str)[0].split('_') if fn_str.strip() else []
+
+
+def _ref_instrument(fmt_stem_lower):
+    for keyword in sorted(INSTRUMENT_KEYWORD_MAP, key=len, reverse=True):
+        if keyword == "percussion":
+            if keyword in fmt_stem_lower: return INSTRUMENT_KEYWORD_MAP[keyword]
+        elif re.search(r'\b' + re.escape(keyword) + r'\b', fmt_stem_lower):
+            return INSTRUMENT_KEYWORD_MAP[keyword]
+    return ""
+
+
+def reference_transform(df_original):
+    """The rules exactly as main.py applied them before any optimization; slow, for checking only."""
+    n_cols = df_original.shape[1]
+    df = df_original.copy(); modified = False
+
+    def has_filename(r_i):
+        fn = df.iloc[r_i, FILENAME_COL_IDX]
+        return pd.notna(fn) and str(fn).strip()
+
+    for col_idx in (A_IDX, AE_IDX):
+        if col_idx >= n_cols or FILENAME_COL_IDX >= n_cols: continue
+        counter = 1
+        for r_i in range(df.shape[0]):
+            if has_filename(r_i):
+                if not (pd.notna(df.iloc[r_i, col_idx]) and str(df.iloc[r_i, col_idx]) == str(counter)):
+                    df.iloc[r_i, col_idx] = counter; modified = True
+                counter += 1
+
+    title_rows, first_track = {}, {}
+    for _, row in df_original.iterrows():
+        if TRACK_TITLE_COL_IDX < n_cols and pd.notna(row.iloc[TRACK_TITLE_COL_IDX]):
+            title_in_r = str(row.iloc[TRACK_TITLE_COL_IDX]).strip()
+            if title_in_r and title_in_r not in title_rows: title_rows[title_in_r] = row
+        if FILENAME_COL_IDX < n_cols and pd.notna(row.iloc[FILENAME_COL_IDX]):
+            fn = str(row.iloc[FILENAME_COL_IDX])
+            title = (_ref_title(fn) or "").strip()
+            parts = _ref_parts(fn)
+            if title and title not in first_track and len(parts) >= 2 and parts[1]:
+                first_track[title] = parts[1]
+
+    cols_to_copy = [ci for ci in range(n_cols) if ci not in EXCLUDED_COL_INDICES and ci != TRACK_TITLE_COL_IDX]
+    for row_idx, row in df.iterrows():
+        if FILENAME_COL_IDX >= n_cols: continue
+        fn_b = row.iloc[FILENAME_COL_IDX]
+        tt_r = row.iloc[TRACK_TITLE_COL_IDX] if TRACK_TITLE_COL_IDX < len(row) else ""
+        if not (pd.notna(fn_b) and str(fn_b).strip()): continue
+        fn = str(fn_b)
+        title = (_ref_title(fn) or "").strip()
+        fmt_stem = _ref_format_stem(_ref_raw_stem(fn))
+        is_vocal = "vocal" in fmt_stem.lower()
+        src = None
+
+        if title and (pd.isna(tt_r) or str(tt_r).strip() == ""):
+            modified = True
+            df.iloc[row_idx, TRACK_TITLE_COL_IDX] = title
+            if title in title_rows:
+                src = title_rows[title]
+                for ci in cols_to_copy:
+                    if ci < len(src): df.iloc[row_idx, ci] = src.iloc[ci]
+            if V_IDX < n_cols and title in first_track: df.iloc[row_idx, V_IDX] = first_track[title]
+
+        if _ref_raw_stem(fn) is None: continue
+        modified = True
+        fmt_stem_lower = fmt_stem.lower()
+        if Y_IDX < n_cols:
+            instrument = _ref_instrument(fmt_stem_lower) if fmt_stem_lower else ""
+            if instrument: df.iloc[row_idx, Y_IDX] = instrument
+        if K_IDX < n_cols: df.iloc[row_idx, K_IDX] = os.path.splitext(fn)[0]
+        if C_IDX < n_cols:
+            p_val = str(df.iloc[row_idx, P_IDX]) if P_IDX < n_cols and pd.notna(df.iloc[row_idx, P_IDX]) else ""
+            df.iloc[row_idx, C_IDX] = f"{p_val} {title} STEM {fmt_stem}".strip()
+        if E_IDX < n_cols: df.iloc[row_idx, E_IDX] = "_".join(_ref_parts(fn)[:2])
+        if S_IDX < n_cols: df.iloc[row_idx, S_IDX] = f"STEM {fmt_stem}".strip()
+        if T_IDX < n_cols:
+            if is_vocal:
+                val_t = "Submix, Song, Lyrics, Vocals"
+                if src is not None and T_IDX < len(src):
+                    source_t = str(src.iloc[T_IDX])
+                    modified_t = re.sub(r'\bFull\b', 'Submix', source_t, flags=re.IGNORECASE, count=1)
+                    if modified_t != source_t: val_t = modified_t
+                    elif source_t.strip(): val_t = source_t
+                df.iloc[row_idx, T_IDX] = val_t
+            else:
+                df.iloc[row_idx, T_IDX] = "Submix, No Lyrics, No Vocals"
+        if U_IDX < n_cols: df.iloc[row_idx, U_IDX] = "N"
+        if AI_IDX < n_cols and is_vocal and src is not None and AI_IDX < len(src):
+            df.iloc[row_idx, AI_IDX] = src.iloc[AI_IDX]
+        if BC_IDX < n_cols:
+            df.iloc[row_idx, BC_IDX] = "1" if is_vocal else "0"
+            if BD_IDX < n_cols:
+                if not is_vocal:
+                    df.iloc[row_idx, BD_IDX] = "No Vocal"
+                elif fmt_stem_lower in ("vocal background", "vocals background"):
+                    df.iloc[row_idx, BD_IDX] = "Vocal Textures - Vocal Background"
+                elif src is not None and BD_IDX < len(src):
+                    df.iloc[row_idx, BD_IDX] = src.iloc[BD_IDX]
+    return df, modified
+
+
+def assert_same_cells(expected, actual):
+    # Same values, dtypes and Python types per cell (an int written where a str was expected counts)
+    pd.testing.assert_frame_equal(expected, actual, check_dtype=True)
+    for ci in range(expected.shape[1]):
+        for r_i, (x, y) in enumerate(zip(expected.iloc[:, ci].tolist(), actual.iloc[:, ci].tolist())):
+            if type(x) is not type(y) and not (isinstance(x, float) and isinstance(y, float)):
+                raise AssertionError(f"cell {index_to_excel_col(ci)}{r_i + 2}: {x!r} vs {y!r}")
+
+
+def read_cells(xlsx_bytes):
+    # Every cell as stored (no type inference), so a '0' written as the number 0 shows up
+    return pd.read_excel(io.BytesIO(xlsx_bytes), engine='openpyxl', dtype=object)
+
+
+def check_equivalence(data, chunk_rows=STREAMING_CHUNK_ROWS):
+    """Compare every optimized output path with reference_transform; returns {path: 'ok' | error}.
+
+    The streaming path reads chunk_rows rows at a time; below the row count it crosses chunks.
+    """
+    df_original = read_uploaded_excel('check.xlsx', data)
+    expected, expected_modified = reference_transform(df_original)
+    expected_output = write_workbook(expected)
+    expected_readback = read_uploaded_excel('check.xlsx', expected_output)
+    report = {}
+
+    def record(path, check):
+        try:
+            check(); report[path] = 'ok'
+        except AssertionError as e:
+            report[path] = f"mismatch: {e}"
+
+    def check_memory(dtype_backend='numpy', transform_workers=1):
+        frame = to_arrow_frame(df_original) if dtype_backend == 'pyarrow' else df_original
+        if transform_workers > 1:
+            actual, modified = transform_dataframe_parallel(frame, transform_workers)
+        else:
+            actual, modified = transform_dataframe(frame)
+        assert modified == expected_modified, f"modified flag {modified} vs {expected_modified}"
+        assert_same_cells(expected, to_numpy_frame(actual))
+
+    def check_output(options):
+        result = process_file('check.xlsx', data, options)
+        assert result.status == 'processed', f"{result.status}: {result.message}"
+        assert_same_cells(expected_readback, read_uploaded_excel('check.xlsx', result.output))
+
+    record('memory', check_memory)
+    record('memory (pyarrow)', lambda: check_memory('pyarrow'))
+    record('memory (3 processes)', lambda: check_memory(transform_workers=3))
+    record('memory (pyarrow, 3 processes)', lambda: check_memory('pyarrow', transform_workers=3))
+    def check_streaming():
+        scan = scan_workbook(data, chunk_rows)
+        output, modified = stream_transform_workbook(data, scan, chunk_rows)
+        assert modified == expected_modified, f"modified flag {modified} vs {expected_modified}"
+        assert_same_cells(read_cells(expected_output), read_cells(output))
+
+    record('streaming', check_streaming)
+    record('patch', lambda: check_output(ProcessOptions('memory', True, 'patch')))
+    return report
+
+
+# --- Phase Timing ---
+def run_scenario(rows, stem_ratio, title_count, seed=0, trace_memory=False, dtype_backend='numpy'):
+    data = make_workbook(rows, stem_ratio, title_count, seed)
+    parse_filename.cache_clear()  # earlier scenarios must not pre-warm the filename cache
+    timer = PhaseRecorder(trace_memory)
+    if trace_memory: tracemalloc.start()
+    try:
+        with timer.phase('read'):
+            df_original = read_uploaded_excel('bench.xlsx', data)
+        if dtype_backend == 'pyarrow':
+            with timer.phase('to arrow'):
+                df_original = to_arrow_frame(df_original)
+        frame_bytes = int(df_original.memory_usage(deep=True).sum())
+        with timer.phase('maps'):
+            parsed_filenames = parse_filename_cells(df_original)
+            lookup_maps = build_lookup_maps(df_original, parsed_filenames)
+        with timer.phase('transform'):
+            df_processed, _ = transform_chunk(df_original, lookup_maps, 0, parsed_filenames)
+        if dtype_backend == 'pyarrow':
+            with timer.phase('to numpy'):
+                df_processed = to_numpy_frame(df_processed)
+        with timer.phase('widths'):
+            compute_column_widths(df_processed)
+        with timer.phase('serialize'):
+            output = write_workbook(df_processed, fit_widths=False)
+        with timer.phase('zip'):
+            with zipfile.ZipFile(io.BytesIO(), 'w', zipfile.ZIP_DEFLATED) as zf: zf.writestr('bench.xlsx', output)
+    finally:
+        if trace_memory: tracemalloc.stop()
+    phases = {record.phase: {'seconds': round(record.seconds, 4)} for record in timer.phases}
+    if trace_memory:
+        for record in timer.phases: phases[record.phase]['peak_mb'] = round(record.peak_mb, 2)
+    total = sum(record.seconds for record in timer.phases)
+    return {'rows': rows, 'stem_ratio': stem_ratio, 'titles': title_count, 'dtype_backend': dtype_backend,
+            'input_bytes': len(data), 'output_bytes': len(output), 'frame_mb': round(frame_bytes / 2 ** 20, 2),
+            'phases': phases, 'total_seconds': round(total, 4),
+            'rows_per_second': round(rows / total, 1) if total else None}
+
+
+def compare_backends(scenarios):
+    # pyarrow relative to numpy for every scenario run with both: frame memory and transform time
+    by_key = {}
+    for sc in scenarios: by_key.setdefault((sc['rows'], sc['stem_ratio'], sc['titles']), {})[sc['dtype_backend']] = sc
+    comparison = []
+    for (rows, stem_ratio, titles), runs in by_key.items():
+        if 'numpy' not in runs or 'pyarrow' not in runs: continue
+        numpy_run, arrow_run = runs['numpy'], runs['pyarrow']
+
+        def transform_seconds(run):
+            return sum(run['phases'][p]['seconds'] for p in ('to arrow', 'maps', 'transform', 'to numpy')
+                       if p in run['phases'])
+
+        comparison.append({'rows': rows, 'stem_ratio': stem_ratio, 'titles': titles,
+                           'frame_mb': [numpy_run['frame_mb'], arrow_run['frame_mb']],
+                           'frame_mb_ratio': round(arrow_run['frame_mb'] / numpy_run['frame_mb'], 3),
+                           'transform_seconds': [round(transform_seconds(numpy_run), 4),
+                                                 round(transform_seconds(arrow_run), 4)],
+                           'total_seconds': [numpy_run['total_seconds'], arrow_run['total_seconds']]})
+    return comparison
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark XL MASTER phases on synthetic cue sheets.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000], help="Row counts to benchmark")
+    parser.add_argument('--stem-ratio', type=float, nargs='+', default=[0.5], help="Share of _STEM filename rows")
+    parser.add_argument('--titles', type=int, nargs='+', default=[100], help="Distinct track titles per sheet")
+    parser.add_argument('--dtype-backend', nargs='+', choices=DTYPE_BACKENDS, default=['numpy'],
+                        help="Column backends to run; give both to get a numpy/pyarrow comparison")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Record per-phase tracemalloc peaks (much slower)")
+    parser.add_argument('--check-rows', type=int, default=500,
+                        help="Rows in the equivalence-check workbook, streamed in quarter-size chunks; 0 skips the check")
+    parser.add_argument('-o', '--output', metavar='PATH', help="Also write the JSON report to this file")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    report = {'rules_version': RULES_VERSION, 'python': platform.python_version(), 'pandas': pd.__version__,
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scenarios': []}
+    for rows in args.rows:
+        for stem_ratio in args.stem_ratio:
+            for title_count in args.titles:
+                for dtype_backend in args.dtype_backend:
+                    print(f"rows={rows} stem_ratio={stem_ratio} titles={title_count} {dtype_backend}", file=sys.stderr)
+                    report['scenarios'].append(run_scenario(rows, stem_ratio, title_count, args.seed,
+                                                            args.trace_memory, dtype_backend))
+    if len(args.dtype_backend) > 1: report['backend_comparison'] = compare_backends(report['scenarios'])
+    if args.check_rows:
+        # Streamed in four chunks at least, so column types have to hold across chunk boundaries
+        chunk_rows = min(STREAMING_CHUNK_ROWS, max(args.check_rows // 4, 1))
+        print(f"equivalence check on {args.check_rows} rows ({chunk_rows}-row chunks)", file=sys.stderr)
+        report['equivalence'] = check_equivalence(
+            make_check_workbook(args.check_rows, args.stem_ratio[0], args.titles[0], args.seed), chunk_rows)
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report['peak_rss_mb'] = round(max_rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(output + "\n")
+    return 0 if all(v == 'ok' for v in report.get('equivalence', {}).values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+import os
+import pickle
+import hashlib
+import threading
+
+import cachetools
+
+from processing import RULES_VERSION
+
+# Results of process_file keyed by the uploaded bytes, the rule set and the output options,
+# so re-uploading an unchanged workbook returns its previous output without reprocessing.
+# The memory tier is an LRU bounded by total output size; the optional disk tier keeps
+# pickled results under cache_dir and evicts the least recently used files beyond its limit.
+
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_BYTES = 2 * 1024 * 1024 * 1024
+_DISK_SUFFIX = '.result'
+
+
+def settings_key(options):
+    # Everything besides the input that decides the output. Streaming vs in-memory processing, either
+    # dtype backend and any number of transform workers yield the same cells, so those are not in it
+    sheets = options.sheets if options.sheets in (None, 'all') else \
+        hashlib.sha256("\n".join(options.sheets).encode()).hexdigest()[:12]  # names may not be filename-safe
+    return f"{RULES_VERSION}-{int(bool(options.fit_widths))}-{options.output_mode}-{options.output_format}-{sheets}"
+
+
+def cache_key(data, options):
+    return f"{hashlib.sha256(data).hexdigest()}-{settings_key(options)}"
+
+
+def _result_size(result):
+    return len(result.output or b"") + 1024  # flat allowance for name, shape and message
+
+
+class ResultCache:
+    """Two-tier LRU of FileResults; only 'processed' and 'unchanged' results are stored."""
+
+    def __init__(self, max_memory_bytes=DEFAULT_MEMORY_BYTES, cache_dir=None, max_disk_bytes=DEFAULT_DISK_BYTES):
+        self._memory = cachetools.LRUCache(maxsize=max_memory_bytes, getsizeof=_result_size)
+        self._lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = self.misses = 0
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + _DISK_SUFFIX)
+
+    def get(self, name, data, options):
+        key = cache_key(data, options)
+        with self._lock:
+            result = self._memory.get(key)
+        if result is None and self.cache_dir:
+            result = self._read_disk(key)
+            if result is not None: self._remember(key, result)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # Same bytes may have been uploaded under another name
+        return result._replace(name=name, metrics=None, cached=True)
+
+    def put(self, data, options, result):
+        if result.status not in ('processed', 'unchanged'): return
+        key = cache_key(data, options)
+        result = result._replace(metrics=None)  # timings belong to the run that produced the result
+        self._remember(key, result)
+        if self.cache_dir: self._write_disk(key, result)
+
+    def _remember(self, key, result):
+        with self._lock:
+            try:
+                self._memory[key] = result
+            except ValueError:
+                pass  # larger than the whole memory tier; the disk tier may still hold it
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f: result = pickle.load(f)
+            os.utime(path)  # mtime doubles as the disk tier's recency
+            return result
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None  # unreadable entry (partial write, older format); treated as a miss
+
+    def _write_disk(self, key, result):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f: pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(_DISK_SUFFIX): continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._memory),
+                    'memory_bytes': self._memory.currsize}
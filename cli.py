@@ -0,0 +1,151 @@
+import os
+import sys
+import glob
+import json
+import zipfile
+import argparse
+
+from batch import (DEFAULT_MAX_WORKERS, INPUT_EXTENSIONS, OUTPUT_MODES, PROCESSING_MODES, ProcessOptions, process_path,
+                   run_batch)
+from preflight import preflight_path
+from processing import DTYPE_BACKENDS
+from tables import OUTPUT_FORMATS, output_name
+
+# Headless batch processor: same rules as the Streamlit app, no Streamlit import.
+#   python cli.py incoming/ "archive/**/*.xlsx" -o processed/ -j 8 --summary summary.json
+#   python cli.py incoming/ --preflight     (report only: exit status 1 if any file would fail)
+#   python cli.py export.parquet -o loaded/ --output-format parquet
+
+
+def collect_input_files(patterns, recursive=False):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*') if recursive else os.path.join(pattern, '*')
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if os.path.isfile(path) and path.lower().endswith(INPUT_EXTENSIONS) \
+                    and not os.path.basename(path).startswith('~$'):  # skip Excel lock files
+                paths.append(os.path.abspath(path))
+    return list(dict.fromkeys(paths))
+
+
+def add_processing_arguments(parser):
+    parser.add_argument('--mode', choices=PROCESSING_MODES, default='auto',
+                        help="'streaming' reads and writes rows in chunks for huge sheets; "
+                             "'auto' (default) streams only above the row threshold")
+    parser.add_argument('--output-mode', choices=OUTPUT_MODES, default='rewrite',
+                        help="'patch' updates only the changed cells of the original .xlsx, keeping its formatting")
+    parser.add_argument('--dtype-backend', choices=DTYPE_BACKENDS, default='numpy',
+                        help="'pyarrow' holds in-memory sheets in Arrow columns while transforming (less memory)")
+    parser.add_argument('--no-fit-widths', action='store_true',
+                        help="Skip column width fitting (outputs read by machines, not people)")
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='xlsx',
+                        help="Write outputs as Excel (default), Parquet or CSV; Parquet/CSV skip the OOXML writer")
+    parser.add_argument('--sheets', default='first',
+                        help="Worksheets to process: 'first' (default), 'all', or comma-separated sheet names; "
+                             "several sheets are written back into one workbook")
+    parser.add_argument('--transform-workers', type=int, metavar='N',
+                        help="Processes sharing the transform of one file: the row blocks of a large in-memory "
+                             "sheet, or its worksheets (default: 1, or --workers when there is a single input)")
+
+
+def options_from_args(args):
+    sheets = None if args.sheets == 'first' else 'all' if args.sheets == 'all' else \
+        tuple(s.strip() for s in args.sheets.split(',') if s.strip())
+    return ProcessOptions(args.mode, not args.no_fit_widths, args.output_mode, dtype_backend=args.dtype_backend,
+                          transform_workers=args.transform_workers or 1, output_format=args.output_format,
+                          sheets=sheets)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Batch-process XL MASTER cue sheets without the web UI.")
+    parser.add_argument('inputs', nargs='+',
+                        help="Input .xlsx/.xls/.parquet/.csv files, directories or glob patterns")
+    parser.add_argument('-o', '--output-dir', help="Directory for processed workbooks (required unless --preflight)")
+    parser.add_argument('--zip', metavar='NAME', help="Write all outputs into this zip (inside --output-dir)")
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f"Worker processes (default: {DEFAULT_MAX_WORKERS})")
+    parser.add_argument('-r', '--recursive', action='store_true', help="Recurse into input directories")
+    add_processing_arguments(parser)
+    parser.add_argument('--preflight', action='store_true',
+                        help="Only scan the headers and columns B/R and report what processing would do")
+    parser.add_argument('--summary', metavar='PATH', help="Also write the JSON summary to this file")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    paths = collect_input_files(args.inputs, args.recursive)
+    if not paths:
+        parser.error("no .xlsx/.xls/.parquet/.csv files matched the given inputs")
+    names = [output_name(os.path.basename(p), args.output_format) for p in paths]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        parser.error(f"several inputs share an output name: {', '.join(duplicates)}")
+    if args.preflight:
+        return run_preflight_report(paths, args)
+    if not args.output_dir:
+        parser.error("the following arguments are required: -o/--output-dir")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    zip_path = os.path.join(args.output_dir, args.zip) if args.zip else None
+    zf = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) if zip_path else None
+    summary = {'processed': [], 'skipped': [], 'errored': []}
+
+    def handle_result(done_count, result):
+        if result.status == 'processed':
+            out_name = output_name(result.name, options.output_format)
+            if zf is not None:
+                zf.writestr(out_name, result.output); output = f"{zip_path}:{out_name}"
+            else:
+                output = os.path.join(args.output_dir, out_name)
+                with open(output, 'wb') as f: f.write(result.output)
+            summary['processed'].append({'name': result.name, 'output': output, 'changed_cells': result.changed_cells,
+                                         'diff': [change._asdict() for change in result.diff],
+                                         'sheets': [sheet._asdict() for sheet in result.sheets]})
+        elif result.status == 'unchanged':
+            summary['skipped'].append({'name': result.name, 'reason': "no changes required"})
+        else:
+            summary['errored'].append({'name': result.name, 'message': result.message,
+                                       'sheets': [sheet._asdict() for sheet in result.sheets]})
+            print(result.message, file=sys.stderr)
+        print(f"[{done_count}/{len(paths)}] {result.status}: {result.name}", file=sys.stderr)
+
+    options = options_from_args(args)
+    if len(paths) == 1 and args.transform_workers is None:  # the batch pool would have nothing else to do
+        options = options._replace(transform_workers=args.workers)
+    try:
+        run_batch([(p, options) for p in paths], max_workers=args.workers, on_result=handle_result,
+                  worker=process_path, keep_outputs=False)
+    finally:
+        if zf is not None: zf.close()
+
+    summary['counts'] = {k: len(summary[k]) for k in ('processed', 'skipped', 'errored')}
+    report = json.dumps(summary, indent=2, default=str)  # diff values can be dates
+    print(report)
+    if args.summary:
+        with open(args.summary, 'w') as f: f.write(report + "\n")
+    return 1 if summary['errored'] else 0
+
+
+def run_preflight_report(paths, args):
+    def handle_report(done_count, report):
+        print(f"[{done_count}/{len(paths)}] {report.status}: {report.name}"
+              + (f" ({report.message})" if report.message else ""), file=sys.stderr)
+
+    reports = run_batch([(p,) for p in paths], max_workers=args.workers, on_result=handle_report,
+                        worker=preflight_path)
+    # A worker crash comes back as a FileResult, which has no counts
+    summary = [r._asdict() if hasattr(r, 'stem_rows') else {'name': r.name, 'status': 'error', 'message': r.message}
+               for r in reports]
+    report = json.dumps(summary, indent=2, default=float)
+    print(report)
+    if args.summary:
+        with open(args.summary, 'w') as f: f.write(report + "\n")
+    return 1 if any(r['status'] == 'error' for r in summary) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
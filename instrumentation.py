@@ -0,0 +1,105 @@
+import io
+import csv
+import json
+import time
+import pstats
+import marshal
+import cProfile
+import tracemalloc
+import contextlib
+import collections
+
+# Per-phase measurements for one file: wall time, rows, cells written and (optionally) the
+# tracemalloc peak. Records are plain namedtuples so they travel back from worker processes.
+
+PhaseRecord = collections.namedtuple('PhaseRecord', ['phase', 'seconds', 'rows', 'cells_written', 'peak_mb'])
+# profile_text is a pstats summary; profile_data is loadable with pstats.Stats / snakeviz once saved
+FileMetrics = collections.namedtuple('FileMetrics', ['phases', 'profile_text', 'profile_data'], defaults=["", b""])
+REPORT_FIELDS = ['file', 'status', 'phase', 'seconds', 'rows', 'rows_per_sec', 'cells_written', 'peak_mb']
+PROFILE_TOP_FUNCTIONS = 40
+
+
+class PhaseRecorder:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name, rows=0):
+        """Time the block; the yielded dict can update 'rows' and 'cells_written' before it ends."""
+        counts = {'rows': rows, 'cells_written': 0}
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing: tracemalloc.start()
+        if self.trace_memory: tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            seconds = time.perf_counter() - start
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20 if self.trace_memory else None
+            if started_tracing: tracemalloc.stop()
+            self.phases.append(PhaseRecord(name, seconds, counts['rows'], counts['cells_written'], peak_mb))
+
+
+def count_edited_cells(edits):
+    return sum(len(positions) for positions, _ in edits)
+
+
+@contextlib.contextmanager
+def optional_profile(enabled):
+    # Yields a cProfile.Profile that is collecting, or None when profiling is off
+    if not enabled:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+
+
+def file_metrics(recorder, profiler=None):
+    if profiler is None: return FileMetrics(recorder.phases)
+    text_buffer = io.StringIO()
+    stats = pstats.Stats(profiler, stream=text_buffer)
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    return FileMetrics(recorder.phases, text_buffer.getvalue(), marshal.dumps(stats.stats))
+
+
+# --- Reports ---
+def report_rows(results, extra_phases=()):
+    """Flatten FileResults into table rows; extra_phases are (name, PhaseRecord) for batch-level steps."""
+    rows = []
+
+    def add(file_name, status, record):
+        rows.append({'file': file_name, 'status': status, 'phase': record.phase,
+                     'seconds': round(record.seconds, 4), 'rows': record.rows,
+                     'rows_per_sec': round(record.rows / record.seconds, 1) if record.rows and record.seconds else None,
+                     'cells_written': record.cells_written,
+                     'peak_mb': round(record.peak_mb, 2) if record.peak_mb is not None else None})
+
+    for result in results:
+        if result.metrics is None:  # cache hit, or cancelled / crashed before any phase was timed
+            add(result.name, result.status, PhaseRecord(
+                'cache hit' if result.cached else result.status, 0.0, result.shape[0], 0, None))
+            continue
+        for record in result.metrics.phases: add(result.name, result.status, record)
+        if len(result.metrics.phases) > 1:
+            add(result.name, result.status, PhaseRecord(
+                'total', sum(r.seconds for r in result.metrics.phases), result.shape[0],
+                sum(r.cells_written for r in result.metrics.phases),
+                max((r.peak_mb for r in result.metrics.phases if r.peak_mb is not None), default=None)))
+    for name, record in extra_phases: add(name, "", record)
+    return rows
+
+
+def report_json(rows):
+    return json.dumps(rows, indent=2).encode()
+
+
+def report_csv(rows):
+    text_buffer = io.StringIO()
+    writer = csv.DictWriter(text_buffer, fieldnames=REPORT_FIELDS)
+    writer.writeheader(); writer.writerows(rows)
+    return text_buffer.getvalue().encode()
@@ -0,0 +1,89 @@
+import time
+import uuid
+import threading
+
+from batch import cache_lookup_counts, run_batch
+
+# Batches run on a background thread so the Streamlit script returns immediately and reruns
+# only poll a snapshot. Jobs live in a process-wide registry keyed by id, so they survive
+# reruns; the UI keeps just the job id in st.session_state.
+
+FINISHED_JOB_TTL_SECONDS = 60 * 60
+JOB_STATES = ('running', 'done', 'cancelled', 'failed')
+
+
+class BatchJob:
+    def __init__(self, files, on_result=None, **run_batch_kwargs):
+        self.id = uuid.uuid4().hex
+        self.names = [args[0] for args in files]
+        self.state = 'running'
+        self.error = ""
+        self.results = []
+        self.cache_counts = None  # (hits, misses) of this job's cache lookups, when it was given a cache
+        self.file_progress = [0.0] * len(files)
+        self.done_count = 0
+        self.started = time.time()
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._on_result = on_result
+        self._thread = threading.Thread(target=self._run, args=(files, run_batch_kwargs), daemon=True,
+                                        name=f"batch-job-{self.id[:8]}")
+
+    def _run(self, files, run_batch_kwargs):
+        try:
+            results = run_batch(files, on_result=self._record_result, on_progress=self._record_progress,
+                                cancel_event=self.cancel_event, **run_batch_kwargs)
+            state = 'cancelled' if self.cancel_event.is_set() else 'done'
+        except Exception as e:  # pool could not start, spool disk full, ...
+            results, state = [], 'failed'
+            self.error = f"{type(e).__name__}: {e}"
+        with self._lock:
+            if run_batch_kwargs.get('cache') is not None: self.cache_counts = cache_lookup_counts(files, results)
+            self.results, self.state, self.finished = results, state, time.time()
+
+    def _record_result(self, done_count, result):
+        if self._on_result: self._on_result(done_count, result)
+        with self._lock:
+            self.done_count = done_count
+
+    def _record_progress(self, file_index, fraction):
+        with self._lock:
+            self.file_progress[file_index] = max(self.file_progress[file_index], fraction)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def running(self):
+        return self.state == 'running'
+
+    def progress(self):
+        """(overall fraction, files done)"""
+        with self._lock:
+            total = len(self.file_progress)
+            return (sum(self.file_progress) / total if total else 1.0), self.done_count
+
+
+class JobRegistry:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, files, on_result=None, **run_batch_kwargs):
+        """Start run_batch(files, ...) in the background; on_result runs on the job's thread."""
+        job = BatchJob(files, on_result, **run_batch_kwargs)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        job._thread.start()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.time() - FINISHED_JOB_TTL_SECONDS
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
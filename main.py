@@ -1,567 +1,283 @@
 import streamlit as st
-import pandas as pd
 import os
-import io
-import zipfile
-import base64
+import html
+import json
 import time
 import uuid
-import re
-
-# from openpyxl.utils import get_column_letter # Not strictly needed if using cell.column_letter
-
-# --- Configuration (Using Excel Column Letters) ---
-FILENAME_COLUMN_LETTER = 'B'
-TRACK_TITLE_COLUMN_LETTER = 'R'
-
-EXCLUDED_COLUMNS_LETTERS = [
-    'A', 'B', 'C', 'D', 'E', 'K', 'S', 'T', 'U', 'V', 'X', 'Y',
-    'AE', 'AI', 'AP', 'BC', 'BD'  # AI is rule-defined but based on source AI
-]
-
-
-# --- End of Configuration ---
-
-# --- Helper Functions ---
-def excel_col_to_index(col_str):
-    if not isinstance(col_str, str) or not col_str.isalpha():
-        raise ValueError(f"Invalid Excel column letter: {col_str}")
-    index = 0;
-    col_str = col_str.upper()
-    for char in col_str: index = index * 26 + (ord(char) - ord('A') + 1)
-    return index - 1
-
-
-def index_to_excel_col(n):
-    n_orig = n;
-    n += 1;
-    string = ""
-    if n <= 0: return f"InvalidIndex({n_orig})"
-    while n > 0: n, rem = divmod(n - 1, 26); string = chr(65 + rem) + string
-    return string
-
 
 try:
-    FILENAME_COL_IDX = excel_col_to_index(FILENAME_COLUMN_LETTER)
-    TRACK_TITLE_COL_IDX = excel_col_to_index(TRACK_TITLE_COLUMN_LETTER)
-    EXCLUDED_COL_INDICES = sorted(list(set(excel_col_to_index(c) for c in EXCLUDED_COLUMNS_LETTERS)))
-    A_IDX = excel_col_to_index('A');
-    C_IDX = excel_col_to_index('C');
-    E_IDX = excel_col_to_index('E')
-    K_IDX = excel_col_to_index('K');
-    P_IDX = excel_col_to_index('P');
-    S_IDX = excel_col_to_index('S')
-    T_IDX = excel_col_to_index('T');
-    U_IDX = excel_col_to_index('U');
-    AE_IDX = excel_col_to_index('AE')
-    AI_IDX = excel_col_to_index('AI');
-    BC_IDX = excel_col_to_index('BC');
-    BD_IDX = excel_col_to_index('BD')
-    V_IDX = excel_col_to_index('V');
-    Y_IDX = excel_col_to_index('Y')
+    from batch import DEFAULT_MAX_WORKERS, ProcessOptions
+    from cache import ResultCache
+    from instrumentation import PhaseRecorder, report_csv, report_json, report_rows
+    from jobs import JobRegistry
+    from preflight import report_frame, run_preflight
+    from processing import DTYPE_BACKENDS, RULES
+    from spool import STATIC_SERVING_MAX_BYTES, OutputSpool, static_url
+    from streaming import STREAMING_ROW_THRESHOLD
+    from tables import OUTPUT_FORMATS, OUTPUT_MIME_TYPES, output_name
 except ValueError as e:
-    st.error(f"Configuration Error in column letters: {e}"); st.stop()
+    st.error(f"Configuration Error in rules: {e}"); st.stop()
 
 
-def get_raw_stem_part_from_filename(fn_str):
-    if not fn_str or not isinstance(fn_str, str): return None
-    name, _ = os.path.splitext(fn_str);
-    m = re.search(r"_STEM(.*)", name)
-    return m.group(1) if m and m.group(1) else None
+# --- Helper Functions ---
+def mime_type_of(file_name):
+    # .xls uploads keep their name but come back as .xlsx content
+    return OUTPUT_MIME_TYPES.get(os.path.splitext(file_name)[1].lstrip('.').lower(), OUTPUT_MIME_TYPES['xlsx'])
 
 
-def format_extracted_stem_part(stem_raw):
-    if not stem_raw or not isinstance(stem_raw, str): return ""
-    txt = str(stem_raw)
-    txt = re.sub(r"([a-z\d])([A-Z])", r"\1 \2", txt)
-    txt = re.sub(r"([A-Z])([A-Z][a-z])", r"\1 \2", txt)
-    txt = re.sub(r"([A-Za-z])(\d)", r"\1 \2", txt)
-    return re.sub(r'\s+', ' ', txt).strip()
+def trigger_download_component(file_url, download_filename):
+    # The browser fetches file_url from the static file server; nothing is inlined in the page
+    script_id = f"dl_script_{uuid.uuid4().hex}"
+    url_js, name_js = json.dumps(file_url), json.dumps(download_filename)
+    return f"""<html><head><meta charset="UTF-8"></head><body><script id="{script_id}">
+        (function(){{var e=document.createElement('a');e.setAttribute('href',{url_js});
+        e.setAttribute('download',{name_js});e.style.display='none';document.body.appendChild(e);
+        try{{e.click();}}catch(err){{console.error('Download click error for '+{name_js}+':',err);}}
+        finally{{document.body.removeChild(e);}}}})();</script></body></html>"""
 
 
-def extract_main_title_from_filename_robust(fn_str):
-    if not isinstance(fn_str, str) or not fn_str.strip(): return None
-    try:
-        name_without_ext, _ = os.path.splitext(fn_str)
-        name_for_title_extraction = name_without_ext
-        suffixes_to_remove = ["_STEM", "_Full"]
-        for suffix_base in suffixes_to_remove:
-            if suffix_base in name_for_title_extraction:
-                name_for_title_extraction = name_for_title_extraction.split(suffix_base)[0]
-                break
-        parts = name_for_title_extraction.split('_')
-        if len(parts) >= 3:
-            title = "_".join(parts[2:]); return title.strip() if title else None
-        elif len(parts) == 2:
-            return parts[1].strip() if parts[1] else None
-        elif len(parts) == 1 and name_for_title_extraction.strip():
-            return name_for_title_extraction.strip()
-    except Exception:
-        return None
-    return None
+def download_link(file_url, download_filename, mime_type):
+    # A plain link to the static file server: rendering it doesn't read the file into the app
+    return (f'<a href="{html.escape(file_url)}" download="{html.escape(download_filename)}" '
+            f'type="{mime_type}">⬇️ Download {html.escape(download_filename)}</a>')
 
 
-def get_track_number_from_filename(fn_str):
-    if not isinstance(fn_str, str) or not fn_str.strip(): return ""
-    name_without_ext, _ = os.path.splitext(str(fn_str));
-    parts = name_without_ext.split('_')
-    if len(parts) >= 2: return parts[1]
-    return ""
+def deliver_spooled_file(path, download_filename, mime_type, auto_download=True):
+    if st.get_option("server.enableStaticServing") and os.path.getsize(path) <= STATIC_SERVING_MAX_BYTES:
+        if auto_download:
+            st.components.v1.html(trigger_download_component(static_url(path), download_filename), height=0,
+                                  scrolling=False)
+        else:  # already delivered: reruns link to the same spooled file
+            st.markdown(download_link(static_url(path), download_filename, mime_type), unsafe_allow_html=True)
+    elif not st.get_option("server.enableStaticServing"):
+        # Any other download route reads the whole file into server memory
+        st.warning(f"{download_filename} can't be downloaded: static file serving (server.enableStaticServing) "
+                   f"is off. It is kept on the server at {path}.")
+    else:
+        st.warning(f"{download_filename} is {os.path.getsize(path) / 2 ** 20:,.0f} MB, more than the "
+                   f"{STATIC_SERVING_MAX_BYTES // 2 ** 20} MB the app can serve. It is kept on the server at {path}; "
+                   f"use cli.py for outputs this large.")
 
 
-def get_col_E_value_from_filename(fn_str):
-    if not isinstance(fn_str, str) or not fn_str.strip(): return ""
-    name_without_ext, _ = os.path.splitext(str(fn_str));
-    parts = name_without_ext.split('_')
-    if len(parts) >= 2:
-        return "_".join(parts[:2])
-    elif len(parts) == 1:
-        return parts[0]
-    return ""
+@st.cache_resource
+def get_job_registry():
+    # One registry per server process; sessions find their job again through the id in session_state
+    return JobRegistry()
 
 
-def auto_adjust_column_width(worksheet):
-    for col in worksheet.columns:
-        max_length = 0;
-        column_letter = col[0].column_letter
-        try:  # Consider header length
-            header_val = worksheet[f"{column_letter}1"].value
-            if header_val: max_length = len(str(header_val))
-        except:
-            pass
+def job_is_running():
+    active_job = st.session_state.get('batch_job')
+    job = get_job_registry().get(active_job['job_id']) if active_job else None
+    return job is not None and job.running
 
-        for cell in col:
-            try:
-                if cell.value:
-                    cell_length = len(str(cell.value))
-                    if cell_length > max_length: max_length = cell_length
-            except:
-                pass
-        adjusted_width = (max_length + 2)
-        if adjusted_width > 70: adjusted_width = 70  # Cap width
-        worksheet.column_dimensions[column_letter].width = adjusted_width
 
+@st.fragment(run_every=1.0)
+def job_progress_panel(job_id):
+    # Reruns on its own every second; only this panel refreshes while the batch works in the background
+    job = get_job_registry().get(job_id)
+    if job is None or not job.running:
+        st.rerun(scope="app"); return
+    fraction, done_count = job.progress()
+    st.info("Processing files..." if not job.cancel_event.is_set() else "Cancelling after the current chunk...")
+    st.progress(min(fraction, 1.0))
+    st.caption(f"{done_count}/{len(job.names)} file(s) finished · {time.time() - job.started:.0f}s elapsed")
+    if st.button("✖ Cancel batch", disabled=job.cancel_event.is_set()):
+        job.cancel()
 
-def trigger_download_component(bin_file, download_filename, mime_type):
-    b64 = base64.b64encode(bin_file).decode();
-    script_id = f"dl_script_{uuid.uuid4().hex}"
-    return f"""<html><head><meta charset="UTF-8"></head><body><script id="{script_id}">
-        (function(){{var e=document.createElement('a');e.setAttribute('href','data:{mime_type};base64,{b64}');
-        e.setAttribute('download','{download_filename}');e.style.display='none';document.body.appendChild(e);
-        try{{e.click();}}catch(err){{console.error('Download click error for {download_filename}:',err);}}
-        finally{{document.body.removeChild(e);}}}})();</script></body></html>"""
+
+@st.cache_resource
+def get_result_cache():
+    # Shared by all sessions; set XL_MASTER_CACHE_DIR to keep results on disk across restarts
+    return ResultCache(cache_dir=os.environ.get("XL_MASTER_CACHE_DIR") or None)
 
 
 st.set_page_config(layout="wide");
 st.title("XL MASTER")
 st.markdown(f"Upload Excel files to batch process them. Downloads will start automatically.")
-uploaded_files = st.file_uploader("Upload Excel files", type=["xlsx", "xls"], accept_multiple_files=True)
+uploaded_files = st.file_uploader("Upload Excel, Parquet or CSV files", type=["xlsx", "xls", "parquet", "csv"],
+                                  accept_multiple_files=True)
+max_workers = st.sidebar.number_input(
+    "Worker processes", min_value=1, value=DEFAULT_MAX_WORKERS, step=1,
+    help="Files are processed in parallel; a single large upload shares its transform across all of them.")
+streaming_mode = st.sidebar.selectbox(
+    "Large-file mode", ["auto", "memory", "streaming"],
+    format_func={"auto": f"Auto (stream above {STREAMING_ROW_THRESHOLD:,} rows)", "memory": "Always in memory",
+                 "streaming": "Always stream"}.get)
+fit_column_widths = st.sidebar.checkbox("Fit column widths", value=True)
+dtype_backend = st.sidebar.selectbox(
+    "In-memory columns", DTYPE_BACKENDS, format_func={"numpy": "Python objects", "pyarrow": "Arrow (less memory)"}.get,
+    help="Arrow keeps text and numeric columns of in-memory sheets as Arrow arrays while they are transformed.")
+output_format = st.sidebar.selectbox(
+    "Output format", OUTPUT_FORMATS,
+    format_func={"xlsx": "Excel workbook", "parquet": "Parquet", "csv": "CSV"}.get,
+    help="Parquet and CSV skip writing the Excel file format, which is most of the time on big sheets.")
+sheet_choice = st.sidebar.selectbox(
+    "Worksheets", ["first", "all", "named"],
+    format_func={"first": "First sheet only", "all": "All sheets", "named": "Sheets named..."}.get,
+    help="Selected sheets are transformed in parallel and written back into one workbook with the others, "
+         "in their original order.")
+sheet_selection = None if sheet_choice == "first" else "all"
+if sheet_choice == "named":
+    sheet_selection = tuple(s.strip() for s in st.sidebar.text_input("Sheet names (comma-separated)").split(",")
+                            if s.strip()) or None
+patch_originals = st.sidebar.checkbox(
+    "Patch original workbooks", value=False,
+    help="Only rewrite the changed cells of each uploaded .xlsx, keeping its formatting and other sheets.")
+reuse_cached_results = st.sidebar.checkbox(
+    "Reuse results for identical uploads", value=True,
+    help="Files whose contents and settings match an earlier run return that run's output without reprocessing.")
+streamed_file_names = st.sidebar.multiselect(
+    "Always stream these files", [f.name for f in uploaded_files or [] if f.name.lower().endswith('.xlsx')])
+with st.sidebar.expander("Diagnostics"):
+    trace_memory = st.checkbox("Measure memory per phase", value=False,
+                               help="Records a tracemalloc peak for every phase. Makes processing much slower.")
+    profiled_file_name = st.selectbox("Profile one file", [None] + [f.name for f in uploaded_files or []],
+                                      format_func=lambda n: "Off" if n is None else n)
+st.sidebar.caption(f"Rules: {RULES.name or os.path.basename(RULES.path)} (version {RULES.version})")
+
+# Pre-flight reports belong to the uploads they were made for; a new upload set drops them
+uploaded_names = [f.name for f in uploaded_files or []]
+if st.session_state.get('preflight', {}).get('names') != uploaded_names:
+    st.session_state.preflight = {'names': uploaded_names, 'reports': None}
+if st.button("🔎 Pre-flight check", disabled=not uploaded_files or job_is_running(),
+             help="Reads only the header row and columns B/R of each file and predicts what processing will do."):
+    with st.spinner("Scanning files..."):
+        st.session_state.preflight['reports'] = report_frame(
+            run_preflight([(f.name, f.getvalue()) for f in uploaded_files], max_workers))
+skipped_file_names = []
+preflight_reports = st.session_state.preflight['reports']
+if preflight_reports is not None:
+    with st.expander("Pre-flight report", expanded=True):
+        st.dataframe(preflight_reports, hide_index=True, use_container_width=True)
+        error_names = preflight_reports.loc[preflight_reports['status'] == 'error', 'name'].tolist()
+        skipped_file_names = st.multiselect("Leave these files out of the batch", uploaded_names,
+                                            default=[n for n in error_names if n in uploaded_names])
 status_area = st.container();
 download_trigger_area = st.container()
 
-if uploaded_files:
-    if st.button("🚀 Process Files and Auto-Download"):
-        processed_data_outputs = [];
-        skipped_files_count = 0;
-        processed_files_count = 0
-        with status_area:
-            st.info("Processing files...");
-            overall_progress_bar = st.progress(0);
-            current_file_status = st.empty()
-            for i, uploaded_file_obj in enumerate(uploaded_files):
-                current_file_status.info(f"Processing: {uploaded_file_obj.name} ({i + 1}/{len(uploaded_files)})")
-                current_df_shape = (0, 0)
-                try:
-                    df_original = pd.read_excel(uploaded_file_obj, engine='openpyxl' if uploaded_file_obj.name.endswith(
-                        '.xlsx') else 'xlrd', header=0)
-                    current_df_shape = df_original.shape
-
-                    df_processed = df_original.copy();
-                    file_was_modified = False
-
-                    if A_IDX < current_df_shape[1]:
-                        ca_val = 1
-                        for r_i in range(df_processed.shape[0]):
-                            if FILENAME_COL_IDX < current_df_shape[1] and pd.notna(
-                                    df_processed.iloc[r_i, FILENAME_COL_IDX]) and str(
-                                    df_processed.iloc[r_i, FILENAME_COL_IDX]).strip():
-                                if not (pd.notna(df_processed.iloc[r_i, A_IDX]) and str(
-                                        df_processed.iloc[r_i, A_IDX]) == str(ca_val)):
-                                    df_processed.iloc[r_i, A_IDX] = ca_val;
-                                    file_was_modified = True
-                                ca_val += 1
-                    if AE_IDX < current_df_shape[1]:
-                        cae_val = 1
-                        for r_i in range(df_processed.shape[0]):
-                            if FILENAME_COL_IDX < current_df_shape[1] and pd.notna(
-                                    df_processed.iloc[r_i, FILENAME_COL_IDX]) and str(
-                                    df_processed.iloc[r_i, FILENAME_COL_IDX]).strip():
-                                if not (pd.notna(df_processed.iloc[r_i, AE_IDX]) and str(
-                                        df_processed.iloc[r_i, AE_IDX]) == str(cae_val)):
-                                    df_processed.iloc[r_i, AE_IDX] = cae_val;
-                                    file_was_modified = True
-                                cae_val += 1
-
-                    source_title_map_for_generic_copy = {}
-                    main_title_to_first_original_track_no_map = {}
-
-                    for _, row_map_data in df_original.iterrows():
-                        if TRACK_TITLE_COL_IDX < current_df_shape[1] and pd.notna(
-                                row_map_data.iloc[TRACK_TITLE_COL_IDX]):
-                            title_in_R = str(row_map_data.iloc[TRACK_TITLE_COL_IDX]).strip()
-                            if title_in_R and title_in_R not in source_title_map_for_generic_copy:
-                                source_title_map_for_generic_copy[title_in_R] = row_map_data
-
-                        if FILENAME_COL_IDX < current_df_shape[1] and pd.notna(row_map_data.iloc[FILENAME_COL_IDX]):
-                            filename_for_map = str(row_map_data.iloc[FILENAME_COL_IDX])
-                            main_title_for_map = extract_main_title_from_filename_robust(filename_for_map)
-                            main_title_for_map = main_title_for_map.strip() if main_title_for_map else ""
-
-                            if main_title_for_map and main_title_for_map not in main_title_to_first_original_track_no_map:
-                                original_track_no = get_track_number_from_filename(filename_for_map)
-                                if original_track_no:
-                                    main_title_to_first_original_track_no_map[main_title_for_map] = original_track_no
-
-                    cols_to_copy = [ci for ci in range(df_processed.shape[1]) if
-                                    ci not in EXCLUDED_COL_INDICES and ci != TRACK_TITLE_COL_IDX]
-
-                    for row_idx, row_s in df_processed.iterrows():
-                        if not (FILENAME_COL_IDX < current_df_shape[1]): continue
-                        if not (FILENAME_COL_IDX < len(row_s)): continue
-
-                        fn_b = row_s.iloc[FILENAME_COL_IDX]
-                        tt_r = row_s.iloc[TRACK_TITLE_COL_IDX] if TRACK_TITLE_COL_IDX < len(row_s) else ""
-
-                        # --- Step 1: Always extract info from filename for every row ---
-                        if not (pd.notna(fn_b) and str(fn_b).strip()):
-                            continue # Skip rows with no filename
-
-                        main_tt_current_row = extract_main_title_from_filename_robust(str(fn_b))
-                        main_tt_current_row = main_tt_current_row.strip() if main_tt_current_row else ""
-                        raw_stem = get_raw_stem_part_from_filename(str(fn_b))
-                        fmt_stem = format_extracted_stem_part(raw_stem)
-                        is_vocal = "vocal" in fmt_stem.lower()
-                        match_src_row_for_generic_copy = None # Reset for each row
-
-                        # --- Step 2: Conditionally fill in MISSING data in Column R and copy other data ---
-                        if main_tt_current_row and (pd.isna(tt_r) or str(tt_r).strip() == ""):
-                            file_was_modified = True
-                            
-                            # A) Fill in the missing track title in Column R
-                            df_processed.iloc[row_idx, TRACK_TITLE_COL_IDX] = main_tt_current_row
-                            
-                            # B) Find a source row to copy data from
-                            if main_tt_current_row in source_title_map_for_generic_copy:
-                                match_src_row_for_generic_copy = source_title_map_for_generic_copy[main_tt_current_row]
-                                for ctc_idx in cols_to_copy:
-                                    if ctc_idx < current_df_shape[1] and ctc_idx < len(match_src_row_for_generic_copy):
-                                        df_processed.iloc[row_idx, ctc_idx] = match_src_row_for_generic_copy.iloc[ctc_idx]
-
-                            # C) Fill Column V
-                            if V_IDX < current_df_shape[1]:
-                                if main_tt_current_row in main_title_to_first_original_track_no_map:
-                                    df_processed.iloc[row_idx, V_IDX] = main_title_to_first_original_track_no_map[main_tt_current_row]
-
-                        # --- Step 3: Populate columns for ALL STEM rows, outside the conditional block ---
-                        # This section now runs for every row that has a filename.
-                        if get_raw_stem_part_from_filename(str(fn_b)) is None:
-                            continue
-
-                        # Mark file as modified when processing STEM rows
-                        file_was_modified = True
-
-                        # Populate Column Y (Instrumentation)
-                        if Y_IDX < current_df_shape[1]:
-                            INSTRUMENT_KEYWORD_MAP = {
-                                "accordion": "Accordion", "alpenhorn": "Alpenhorn/Alpine Horn",
-                                "alpine horn": "Alpenhorn/Alpine Horn",
-                                "autoharp": "Autoharp", "bagpipes": "Bagpipes", "bajo sexto": "Bajo Sexto",
-                                "balafon": "Balafon",
-                                "balalaika": "Balalaika", "bandoneon": "Bandoneon", "bandura": "Bandura",
-                                "banjo": "Banjo",
-                                "bansuri": "Bansuri/Baanhi/Baashi/Bansi/Basari",
-                                "baanhi": "Bansuri/Baanhi/Baashi/Bansi/Basari",
-                                "baashi": "Bansuri/Baanhi/Baashi/Bansi/Basari",
-                                "bansi": "Bansuri/Baanhi/Baashi/Bansi/Basari",
-                                "basari": "Bansuri/Baanhi/Baashi/Bansi/Basari", "bass": "Bass",
-                                "bass drum": "Bass Drum",  # Order might matter if stem is "Bass Drum"
-                                "bassoon": "Bassoon", "batacada": "Batacada", "bawu": "Bawu", "bell tree": "Bell Tree",
-                                "bells": "Bells", "berimbau": "Berimbau", "big band": "Big Band",
-                                "bladder pipe": "Bladder Pipe",
-                                "bodhran": "Bodhran/Frame Drum", "frame drum": "Bodhran/Frame Drum",
-                                "bombard": "Bombard",
-                                "bombo": "Bombo", "bones": "Bones", "bongos": "Bongos", "bottle": "Bottle",
-                                "bouzouki": "Bouzouki",
-                                "bow": "Bow", "brass": "Brass", "bugle": "Bugle", "bullroarer": "Bullroarer/Rhombus",
-                                "rhombus": "Bullroarer/Rhombus", "cabasa": "Cabasa", "calliope": "Calliope",
-                                "carillon": "Carillon",
-                                "castanets": "Castanets", "cavaquinho": "Cavaquinho", "celeste": "Celeste",
-                                "cello": "Cello",
-                                "chapman stick": "Chapman Stick", "charango": "Charango", "chekere": "Chekere/Djabara",
-                                "djabara": "Chekere/Djabara", "chimes": "Chimes/Tubular Bells",
-                                "tubular bells": "Chimes/Tubular Bells",
-                                "cimbalom": "Cimbalom", "cittern": "Cittern", "clarinet": "Clarinet",
-                                "clarsach": "Clarsach",
-                                "claves": "Claves", "clavinet": "Clavinet", "coconuts": "Coconuts",
-                                "comb and paper": "Comb And Paper",
-                                "concertina": "Concertina", "conch shell": "Conch Shell", "congas": "Congas",
-                                "cor anglais": "Cor Anglais/English Horn", "english horn": "Cor Anglais/English Horn",
-                                "cornamuse": "Cornamuse", "cornet": "Cornet", "cornett": "Cornett",
-                                "cowbell": "Cowbell",
-                                "crotales": "Crotales", "crowth": "Crowth", "crumhorn": "Crumhorn", "cuatro": "Cuatro",
-                                "cuica": "Cuica", "cymbals": "Cymbals", "da suo": "Da Suo", "daf": "Daf/Dayereh",
-                                "dayereh": "Daf/Dayereh", "dan bau": "Dan Bau", "darbouka": "Darbouka", "def": "Def",
-                                "descant fiddle": "Descant Fiddle", "dhol": "Dhol", "dholak": "Dholak",
-                                "didgeridoo": "Didgeridoo",
-                                "dilruba": "Dilruba", "dizi": "Dizi", "djembe": "Djembe", "dolceola": "Dolceola",
-                                "double bass": "Double Bass", "doumbek/dumbek": "Doumbek/Dumbek",
-                                "doumbek": "Doumbek/Dumbek", "dumbek": "Doumbek/Dumbek",
-                                "drone": "Drone", "drum kit": "Drum Kit",
-                                "drum machine": "Drum Machine/Electronic Drums",
-                                "electronic drums": "Drum Machine/Electronic Drums", "drum set": "Drum Set",
-                                "drums": "Drums",  # Generic 'drums'
-                                "duck call": "Duck Call", "dudak": "Dudak", "dudu": "Dudu", "duduk": "Duduk",
-                                "duff": "Duff",
-                                "dulcimer": "Dulcimer", "dulcitone": "Dulcitone", "dunun": "Dunun",
-                                "electronic instruments": "Electronic Instruments", "electronics": "Electronics",
-                                "erhu": "Erhu",
-                                "esraj": "Esraj", "ethnic plucked instruments": "Ethnic Plucked Instruments",
-                                "ethnic string instruments": "Ethnic String Instruments",
-                                "ethnic wind instruments": "Ethnic Wind Instruments",
-                                "fiddle": "Fiddle", "fife": "Fife", "finger bells": "Finger Cymbals/Finger Bells",
-                                "finger cymbals": "Finger Cymbals/Finger Bells", "finger snaps": "Finger Snaps",
-                                "flapamba": "Flapamba",
-                                "flexatone": "Flexatone", "flugelhorn": "Flugelhorn", "flute": "Flute", "fue": "Fue",
-                                "gambang": "Gambang", "gamelan": "Gamelan", "gemshorn": "Gemshorn",
-                                "ghaychak": "Ghaychak",
-                                "ghurzen": "Ghurzen", "glockenspiel": "Glockenspiel",
-                                "goblet drum": "Goblet Drum/Dumbec",
-                                "dumbec": "Goblet Drum/Dumbec", "gong": "Gong", "gong - chinese": "Gong - Chinese/Chau",
-                                "chau": "Gong - Chinese/Chau", "gran cassa": "Gran Cassa", "guiro": "Guiro",
-                                "acoustic guitars": "Guitar - Acoustic/Steel String",
-                                "acoustic guitar": "Guitar - Acoustic/Steel String",
-                                "guitar acoustic": "Guitar - Acoustic/Steel String",
-                                "guitars acoustic": "Guitar - Acoustic/Steel String",
-                                "guitar - acoustic": "Guitar - Acoustic/Steel String",
-                                "guitar - distorted electric": "Guitar - Distorted Electric",
-                                "dobro": "Guitar - Dobro", "e-bow": "Guitar - E-Bow",
-                                "electric guitars": "Guitar - Electric",
-                                "electric guitar": "Guitar - Electric",
-                                "guitars electric": "Guitar - Electric",
-                                "guitar electric": "Guitar - Electric",  # Might conflict with "Guitar - Electric"
-                                "guitar - electric": "Guitar - Electric",  # More specific
-                                "pedal steel": "Guitar - Pedal Steel", "guitarron": "Guitarron", "guqin": "Guqin",
-                                "guzheng": "Guzheng",
-                                "hammered dulcimer": "Hammered Dulcimer", "hand claps": "Hand Claps",
-                                "hang drum": "Hang Drum",
-                                "harmonica": "Harmonica", "harmonium": "Harmonium", "harp": "Harp",
-                                "harpsichord": "Harpsichord",
-                                "hi-hat": "Hi-Hat", "hi hat": "Hi-Hat", "hihat": "Hi-Hat", "hichiriki": "Hichiriki",
-                                "horn": "Horn", "french horn": "Horn - French", "horns": "Horns/Horn Section",
-                                "hurdy gurdy": "Hurdy Gurdy",
-                                "jazz trio": "Jazz Trio", "jug": "Jug", "kalimba/sanza": "Kalimba/Sanza",
-                                "kalimba": "Kalimba/Sanza", "sanza": "Kalimba/Sanza",
-                                "kamancheh": "Kamancheh/Kamanche/Kamancha", "kamanche": "Kamancheh/Kamanche/Kamancha",
-                                "kamancha": "Kamancheh/Kamanche/Kamancha", "kanun": "Kanun", "kaval": "Kaval",
-                                "kawala": "Kawala/Salamiya", "salamiya": "Kawala/Salamiya", "kazoo": "Kazoo",
-                                "kecapi": "Kecapi",
-                                "keyboard": "Keyboard", "keys": "Keyboard", "khene": "Khene", "khlui": "Khlui",
-                                "koboz": "Koboz",
-                                "kokyu": "Kokyu", "kora": "Kora", "kortholt": "Kortholt", "koto": "Koto",
-                                "llamas hooves": "Llamas Hooves", "log drum": "Log Drum", "lute": "Lute",
-                                "lyre": "Lyre",
-                                "mallet": "Mallet", "mandira": "Mandira", "mandocello": "Mandocello",
-                                "mandola": "Mandola",
-                                "mandolin": "Mandolin", "maracas": "Maracas", "marimba": "Marimba",
-                                "marimbula": "Marimbula",
-                                "matou qin/morin khuur/horsehead fiddle": "MaTou Qin/Morin Khuur/Horsehead Fiddle",
-                                # This is very long, ensure it's a likely stem name part
-                                "mbira": "Mbira/African Thumb Piano",
-                                "african thumb piano": "Mbira/African Thumb Piano",
-                                "mellophone": "Mellophone", "mellotron": "Mellotron", "melodeon": "Melodeon",
-                                "melodica": "Melodica", "mizmar": "Mizmar", "morin khuur": "Morin Khuur",
-                                "mouth harp": "Mouth Harp/Jews Harp",
-                                "jews harp": "Mouth Harp/Jews Harp", "mouth": "Mouth/Beat Box",
-                                "beat box": "Mouth/Beat Box",
-                                "mridangam": "Mridangam", "mukkuri": "Mukkuri/Tonkori", "tonkori": "Mukkuri/Tonkori",
-                                "musette": "Musette", "music box": "Music Box", "musical saw": "Musical Saw",
-                                "ney": "Ney",
-                                "ngoni": "Ngoni", "non-specific": "Non-specific", "novachord": "Novachord",
-                                "oboe": "Oboe",
-                                "ocarina": "Ocarina", "omnichord": "Omnichord", "orchestra": "Orchestra",
-                                "organ": "Organ",
-                                "wurlitzer": "Organ - Wurlitzer", "oud": "Oud", "pads": "Pads",
-                                "palm court": "Palm Court/Salon Orchestra",
-                                "pan pipes": "Pan Pipes", "percussion": "Percussion", "piano": "Piano", "pipa": "Pipa",
-                                "pipes": "Pipes", "pipes - celtic": "Pipes - Celtic",
-                                "pipes - hornpipe": "Pipes - Hornpipe",
-                                "pipes - pan": "Pipes - Pan", "polyphone": "Polyphone", "quena": "Quena",
-                                "rabbi": "Rabbi",  # Assuming 'rabbi' is correct, not a typo for rabab
-                                "rackett": "Rackett", "rainstick": "Rainstick", "ranat": "Ranat", "ratchet": "Ratchet",
-                                "rebec": "Rebec", "recorder": "Recorder", "reed aerophone": "Reed Aerophone",
-                                "riq": "Riq/Kanjira",
-                                "kanjira": "Riq/Kanjira", "rubab": "Rubab/Robab/Rabab", "robab": "Rubab/Robab/Rabab",
-                                "rabab": "Rubab/Robab/Rabab", "sackbut": "Sackbut", "sanshin": "Sanshin",
-                                "santoor": "Santoor",
-                                "sarangi": "Sarangi", "sarod": "Sarod", "saunter": "Saunter",
-                                # "Saunter" as an instrument?
-                                "saxophone": "Saxophone", "saz lute": "Saz Lute/Baglama", "baglama": "Saz Lute/Baglama",
-                                "scheitholt": "Scheitholt", "scratching": "Scratching", "sfx": "SFX (Sound Effects)",
-                                "effects": "SFX (Sound Effects)", "shaker": "Shaker", "shakuhachi": "Shakuhachi",
-                                "shamisen": "Shamisen", "shawm": "Shawm", "shekere": "Shekere", "shenai": "Shenai",
-                                "sho": "Sho",
-                                "shou": "Shou", "side drum": "Side Drum", "singing bowls": "Singing Bowls",
-                                "sitar": "Sitar",
-                                "snare drum": "Snare Drum", "sound design": "Sound Design", "spoons": "Spoons",
-                                "steel drums": "Steel Drums", "steelpan": "Steelpan", "sticks": "Sticks",
-                                "string ensemble": "String Ensemble", "string quartet": "String Quartet",
-                                "string section": "String Section",
-                                "strings": "Strings", "suling": "Suling", "suona": "Suona", "surbahar": "Surbahar",
-                                "surdo": "Surdo", "synthesizer": "Synthesizer", "synth": "Synthesizer",
-                                "synths": "Synthesizer",
-                                "tabla": "Tabla",
-                                "taiko drum": "Taiko Drum", "talking drum": "Talking Drum", "tambourine": "Tambourine",
-                                "tambura": "Tambura", "tar": "Tar", "tarabuka": "Tarabuka",
-                                "temple bell": "Temple Bell",
-                                "temple blocks": "Temple Blocks", "theremin": "Theremin",
-                                "thunder sheet": "Thunder Sheet",
-                                "tibetan singing bowls": "Tibetan Singing Bowls", "timbale": "Timbale",
-                                "timpani": "Timpani",
-                                "tiompan": "Tiompan", "tom toms": "Tom Toms", "toms": "Tom Toms",
-                                "tongue drum": "Tongue Drum",
-                                "toy instruments": "Toy Instruments", "transverse flute": "Transverse Flute",
-                                "trautonium": "Trautonium",
-                                "triangle": "Triangle", "tromba marina": "Tromba Marina", "trombone": "Trombone",
-                                "trumpet": "Trumpet", "tuba": "Tuba", "udu": "Udu", "ukulele": "Ukulele",
-                                "vibraphone": "Vibraphone", "vibraslap": "Vibraslap", "viol": "Viol", "viola": "Viola",
-                                "viola da gamba": "Viola Da Gamba", "violin": "Violin", "vox": "Vocals", "vocal": "Vocals", "vocals": "Vocals",
-                                "vocoder": "Vocoder",
-                                "washboard": "Washboard", "waterphone": "Waterphone", "whip": "Whip",
-                                "whisper": "Whisper",
-                                "whistle": "Whistle", "wind chimes": "Wind Chimes", "wood block": "Wood Block",
-                                "woodblock": "Wood Block", "woodwinds": "Woodwinds", "xiao": "Xiao",
-                                "xylophone": "Xylophone",
-                                "yangqin": "Yangqin", "zagat": "Zagat", "zither": "Zither",
-                                "zourna/sorna/zurna": "Zourna/Sorna/Zurna",
-                                "sorna": "Zourna/Sorna/Zurna", "zurna": "Zourna/Sorna/Zurna"
-                            }
-                            SORTED_INSTRUMENT_KEYWORDS = sorted(INSTRUMENT_KEYWORD_MAP.keys(), key=len, reverse=True)
-                            val_for_Y = ""
-                            fmt_stem_lower = fmt_stem.lower() if fmt_stem else ""
-                            if fmt_stem_lower:
-                                for keyword in SORTED_INSTRUMENT_KEYWORDS:
-                                    if keyword == "percussion":
-                                        if keyword in fmt_stem_lower:
-                                            val_for_Y = INSTRUMENT_KEYWORD_MAP[keyword]
-                                            break
-                                    elif re.search(r'\b' + re.escape(keyword) + r'\b', fmt_stem_lower):
-                                        val_for_Y = INSTRUMENT_KEYWORD_MAP[keyword]
-                                        break
-                            if val_for_Y:
-                                df_processed.iloc[row_idx, Y_IDX] = val_for_Y
-                        
-                        # Populate other columns for ALL stem rows
-                        if K_IDX < current_df_shape[1]: 
-                            df_processed.iloc[row_idx, K_IDX] = os.path.splitext(str(fn_b))[0]
-                        
-                        if C_IDX < current_df_shape[1]:
-                            p_val = str(df_processed.iloc[row_idx, P_IDX]) if P_IDX < current_df_shape[1] and pd.notna(df_processed.iloc[row_idx, P_IDX]) else ""
-                            df_processed.iloc[row_idx, C_IDX] = f"{p_val} {main_tt_current_row} STEM {fmt_stem}".strip()
-                        
-                        if E_IDX < current_df_shape[1]:
-                            df_processed.iloc[row_idx, E_IDX] = get_col_E_value_from_filename(str(fn_b))
-
-                        if S_IDX < current_df_shape[1]: 
-                            df_processed.iloc[row_idx, S_IDX] = f"STEM {fmt_stem}".strip()
-                        
-                        if T_IDX < current_df_shape[1]:
-                            if is_vocal:
-                                val_T = "Submix, Song, Lyrics, Vocals"
-                                if match_src_row_for_generic_copy is not None and T_IDX < len(match_src_row_for_generic_copy):
-                                    source_T_val_original = str(match_src_row_for_generic_copy.iloc[T_IDX])
-                                    modified_T_val = re.sub(r'\bFull\b', 'Submix', source_T_val_original, flags=re.IGNORECASE, count=1)
-                                    if modified_T_val != source_T_val_original:
-                                        val_T = modified_T_val
-                                    elif source_T_val_original.strip():
-                                        val_T = source_T_val_original
-                                df_processed.iloc[row_idx, T_IDX] = val_T
-                            else:
-                                df_processed.iloc[row_idx, T_IDX] = "Submix, No Lyrics, No Vocals"
-                        
-                        if U_IDX < current_df_shape[1]: 
-                            df_processed.iloc[row_idx, U_IDX] = "N"
-
-                        if AI_IDX < current_df_shape[1]:
-                            if is_vocal and match_src_row_for_generic_copy is not None and AI_IDX < len(match_src_row_for_generic_copy):
-                                df_processed.iloc[row_idx, AI_IDX] = match_src_row_for_generic_copy.iloc[AI_IDX]
-
-                        if BC_IDX < current_df_shape[1]:
-                            val_bc = "1" if is_vocal else "0"
-                            df_processed.iloc[row_idx, BC_IDX] = val_bc
-                            if BD_IDX < current_df_shape[1]:
-                                if val_bc == "1":
-                                    if fmt_stem_lower == "vocal background" or fmt_stem_lower == "vocals background":
-                                        df_processed.iloc[row_idx, BD_IDX] = "Vocal Textures - Vocal Background"
-                                    elif match_src_row_for_generic_copy is not None and BD_IDX < len(match_src_row_for_generic_copy):
-                                        df_processed.iloc[row_idx, BD_IDX] = match_src_row_for_generic_copy.iloc[BD_IDX]
-                                elif val_bc == "0":
-                                    df_processed.iloc[row_idx, BD_IDX] = "No Vocal"
-
-                    if file_was_modified:
-                        output_buffer = io.BytesIO()
-                        with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
-                            df_processed.to_excel(writer, index=False, sheet_name='Sheet1')
-                            worksheet = writer.sheets['Sheet1']
-                            auto_adjust_column_width(worksheet)
-                        processed_data_outputs.append((f"{uploaded_file_obj.name}", output_buffer.getvalue()))
-                        processed_files_count += 1
-                except IndexError as e_idx:
-                    idx_arg = e_idx.args[0] if e_idx.args else -1
-                    col_letter_involved = index_to_excel_col(idx_arg if isinstance(idx_arg, int) else -1)
-                    current_file_status.error(
-                        f"Index Error in {uploaded_file_obj.name}: {e_idx}. Problem with col {col_letter_involved}. File has {current_df_shape[1]} cols.");
-                    skipped_files_count += 1
-                except Exception as e:
-                    current_file_status.error(f"Error processing {uploaded_file_obj.name}: {e}");
-                    import traceback;
-
-                    st.error(traceback.format_exc())
-                    skipped_files_count += 1
-                overall_progress_bar.progress((i + 1) / len(uploaded_files))
-
-            current_file_status.empty()
-            if processed_files_count == 0 and skipped_files_count == 0 and len(uploaded_files) > 0:
-                st.info("Processing complete. No files were modified or met criteria for changes.")
-            elif processed_files_count > 0 or skipped_files_count > 0:
-                st.success(
-                    f"Batch processing complete! {processed_files_count} file(s) processed, {skipped_files_count} file(s) skipped/errored.")
-
-        with download_trigger_area:
-            if not processed_data_outputs:
-                if len(uploaded_files) > 0:
-                    st.info("No files were processed that require downloading.")
-            elif len(processed_data_outputs) == 1:
-                st.success("One file processed. Download should start automatically...")
-                fname, data_val = processed_data_outputs[0]
-                html_dl = trigger_download_component(data_val, fname,
-                                                     "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                st.components.v1.html(html_dl, height=0, scrolling=False)
-            elif len(processed_data_outputs) == 2:
-                st.success("Two files processed. Downloads should start automatically (staggered)...")
-                for idx, (fname, data_val) in enumerate(processed_data_outputs):
-                    if idx > 0: time.sleep(1)
-                    html_dl = trigger_download_component(data_val, fname,
-                                                         "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                    st.components.v1.html(html_dl, height=0, scrolling=False)
-            elif len(processed_data_outputs) > 2:
+batch_uploads = [f for f in uploaded_files or [] if f.name not in skipped_file_names]
+if st.button("🚀 Process Files and Auto-Download", disabled=not batch_uploads or job_is_running()):
+    output_spool = OutputSpool()
+    output_mode = 'patch' if patch_originals else 'rewrite'
+    batch_files = [(f.name, f.getvalue(),
+                    ProcessOptions('streaming' if f.name in streamed_file_names else streaming_mode,
+                                   fit_column_widths, output_mode, trace_memory, f.name == profiled_file_name,
+                                   dtype_backend, max_workers if len(batch_uploads) == 1 else 1, output_format,
+                                   sheet_selection))
+                   for f in batch_uploads]
+    result_cache = get_result_cache() if reuse_cached_results else None
+
+    def spool_result(done_count, result):  # runs on the job's thread: no st.* calls here
+        if result.status == 'processed': output_spool.add(output_name(result.name, output_format), result.output)
+
+    job = get_job_registry().submit(batch_files, on_result=spool_result, max_workers=max_workers,
+                                    keep_outputs=False, cache=result_cache)
+    st.session_state.batch_job = {'job_id': job.id, 'spool': output_spool, 'trace_memory': trace_memory,
+                                  'delivered': False, 'zip': None}
+
+active_job = st.session_state.get('batch_job')
+job = get_job_registry().get(active_job['job_id']) if active_job else None
+if active_job and job is None:  # server restarted or the job expired
+    del st.session_state.batch_job
+elif job is not None and job.running:
+    with status_area:
+        job_progress_panel(job.id)
+elif job is not None:
+    batch_results = job.results
+    processed_files_count = sum(r.status == 'processed' for r in batch_results)
+    skipped_files_count = sum(r.status == 'error' for r in batch_results)
+    output_spool = active_job['spool']
+    with status_area:
+        if job.state == 'failed':
+            st.error(f"Batch failed: {job.error}")
+        elif job.state == 'cancelled':
+            st.warning(f"Batch cancelled after {job.done_count - sum(r.status == 'cancelled' for r in batch_results)} "
+                       f"of {len(job.names)} file(s).")
+        for result in batch_results:
+            if result.status == 'error':
+                st.error(result.message)
+                if result.error_detail: st.error(result.error_detail)
+            elif result.message:  # worksheets that failed in an otherwise processed workbook
+                st.warning(result.message)
+        if processed_files_count == 0 and skipped_files_count == 0 and job.state == 'done':
+            st.info("Processing complete. No files were modified or met criteria for changes.")
+        elif processed_files_count > 0 or skipped_files_count > 0:
+            st.success(
+                f"Batch processing complete! {processed_files_count} file(s) processed, {skipped_files_count} file(s) skipped/errored.")
+        if job.cache_counts:  # counted for this job alone: other sessions share the cache
+            cache_stats, (cache_hits, cache_misses) = get_result_cache().stats(), job.cache_counts
+            st.caption(f"Result cache: {cache_hits} hit(s), {cache_misses} miss(es) "
+                       f"({cache_stats['entries']} cached, {cache_stats['memory_bytes'] / 2 ** 20:.1f} MB in memory)")
+        changed_results = [r for r in batch_results if r.status in ('processed', 'unchanged')]
+        if changed_results:
+            with st.expander("Changed cells"):
+                # A row per file, followed by one per worksheet when several were processed
+                st.dataframe([{'File': r.name, 'Sheet': s_name, 'Status': status, 'Changed cells': cells}
+                              for r in changed_results
+                              for s_name, status, cells in [("", r.status, r.changed_cells)] +
+                              [(sheet.name, sheet.status, sheet.changed_cells) for sheet in r.sheets]],
+                             hide_index=True, use_container_width=True)
+                diff_name = st.selectbox("Show changes of", [r.name for r in changed_results if r.diff])
+                for result in changed_results:
+                    if result.name != diff_name: continue
+                    # str() both sides: a column may mix text and numbers
+                    st.dataframe([{'Cell': c.cell, 'Before': "" if c.old is None else str(c.old),
+                                   'After': "" if c.new is None else str(c.new)} for c in result.diff],
+                                 hide_index=True, use_container_width=True)
+                    if result.changed_cells > len(result.diff):
+                        st.caption(f"First {len(result.diff)} of {result.changed_cells} changed cells.")
+
+    # Downloads start automatically once; later reruns offer buttons for the same spooled files
+    auto_download = not active_job['delivered']
+    active_job['delivered'] = True
+    with download_trigger_area:
+        spooled_outputs = output_spool.entries
+        if not spooled_outputs:
+            if batch_results:
+                st.info("No files were processed that require downloading.")
+            output_spool.cleanup()
+        elif len(spooled_outputs) == 1:
+            if auto_download: st.success("One file processed. Download should start automatically...")
+            fname, path = spooled_outputs[0]
+            deliver_spooled_file(path, fname, mime_type_of(fname), auto_download)
+        elif len(spooled_outputs) == 2:
+            if auto_download: st.success("Two files processed. Downloads should start automatically (staggered)...")
+            for idx, (fname, path) in enumerate(spooled_outputs):
+                if idx > 0 and auto_download: time.sleep(1)
+                deliver_spooled_file(path, fname, mime_type_of(fname), auto_download)
+        elif len(spooled_outputs) > 2:
+            if active_job['zip'] is None:
                 st.success(
-                    f"{len(processed_data_outputs)} files processed. Zipping and download should start automatically...")
-                zip_buffer = io.BytesIO();
-                zip_filename = f"processed_files_{uuid.uuid4().hex[:8]}.zip"
-                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-                    for fname, data_val in processed_data_outputs: zf.writestr(fname, data_val)
-                zip_data = zip_buffer.getvalue()
-                html_dl = trigger_download_component(zip_data, zip_filename, "application/zip")
-                st.components.v1.html(html_dl, height=0, scrolling=False)
-            if processed_data_outputs:
-                st.caption("If downloads don't start, check browser pop-up/download settings.")
+                    f"{len(spooled_outputs)} files processed. Zipping and download should start automatically...")
+                zip_recorder = PhaseRecorder(active_job['trace_memory'])
+                with zip_recorder.phase('zip', len(spooled_outputs)):
+                    zip_parts = output_spool.build_zip_parts(f"processed_files_{uuid.uuid4().hex[:8]}")
+                active_job['zip'] = (zip_parts, zip_recorder.phases)
+            zip_parts, _ = active_job['zip']
+            if len(zip_parts) > 1 and auto_download:
+                st.info(f"The outputs are split into {len(zip_parts)} zips of at most "
+                        f"{STATIC_SERVING_MAX_BYTES // 2 ** 20} MB.")
+            for idx, (zip_filename, zip_path) in enumerate(zip_parts):
+                if idx > 0 and auto_download: time.sleep(1)
+                deliver_spooled_file(zip_path, zip_filename, "application/zip", auto_download)
+        if spooled_outputs and auto_download:
+            st.caption("If downloads don't start, check browser pop-up/download settings.")
+
+    with status_area:
+        zip_phases = active_job['zip'][1] if active_job['zip'] else []
+        metrics_rows = report_rows(batch_results, [("(batch)", record) for record in zip_phases])
+        with st.expander("Performance details"):
+            st.dataframe(metrics_rows, hide_index=True, use_container_width=True)
+            report_name = f"xl_master_metrics_{job.id[:8]}"
+            json_col, csv_col = st.columns(2)
+            json_col.download_button("⬇️ Metrics (JSON)", report_json(metrics_rows), file_name=f"{report_name}.json",
+                                     mime="application/json", on_click="ignore")
+            csv_col.download_button("⬇️ Metrics (CSV)", report_csv(metrics_rows), file_name=f"{report_name}.csv",
+                                    mime="text/csv", on_click="ignore")
+            for result in batch_results:
+                if result.metrics is not None and result.metrics.profile_text:
+                    st.markdown(f"**Profile of {result.name}** (sorted by cumulative time)")
+                    st.code(result.metrics.profile_text, language=None)
+                    st.download_button("⬇️ Profile data (.prof)", result.metrics.profile_data,
+                                       file_name=f"{os.path.splitext(result.name)[0]}.prof",
+                                       mime="application/octet-stream", on_click="ignore")
@@ -0,0 +1,95 @@
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+
+from processing import (FILENAME_COL_IDX, build_lookup_maps, count_filename_rows, parse_filename_cells,
+                        to_numpy_frame, transform_chunk)
+
+# One huge sheet across several cores. The sheet-wide pass (filename parsing, lookup maps and
+# the A/AE counter offset of every block) runs here; blocks of rows are then transformed by
+# transform_chunk() in worker processes and concatenated in order. The maps go to each worker
+# once, through the pool initializer, instead of with every block.
+# map_isolated() spreads independent jobs (the worksheets of one workbook) the same way.
+
+# Below this many rows starting the pool (spawned workers import pandas) costs more than it saves
+PARALLEL_TRANSFORM_MIN_ROWS = 100_000
+
+_worker_lookup_maps = None
+
+
+def _init_transform_worker(lookup_maps):
+    global _worker_lookup_maps
+    _worker_lookup_maps = lookup_maps
+
+
+def _transform_block(df_block, counter_offset, parsed_block):
+    edits = []
+    df_processed, modified = transform_chunk(df_block, _worker_lookup_maps, counter_offset, parsed_block, edits)
+    return df_processed, modified, edits
+
+
+def split_rows(n_rows, n_blocks):
+    """[(start, stop)] of n_blocks nearly equal, consecutive row ranges."""
+    bounds = np.linspace(0, n_rows, n_blocks + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def transform_dataframe_parallel(df_original, max_workers, edits=None):
+    """transform_dataframe() with the row blocks spread over max_workers processes; same result."""
+    n_rows = len(df_original)
+    if FILENAME_COL_IDX >= df_original.shape[1] or n_rows == 0:
+        return df_original.copy(), False
+    parsed_filenames = parse_filename_cells(df_original)
+    lookup_maps = build_lookup_maps(df_original, parsed_filenames)
+    blocks, counter_offset = [], 0
+    for start, stop in split_rows(n_rows, max_workers):
+        df_block = df_original.iloc[start:stop]
+        parsed_block = parsed_filenames[(parsed_filenames.index >= start) & (parsed_filenames.index < stop)]
+        parsed_block.index = parsed_block.index - start
+        blocks.append((start, df_block, counter_offset, parsed_block))
+        counter_offset += count_filename_rows(df_block)
+
+    # spawn, as in batch.run_batch: the caller may be a multi-threaded server
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(blocks), mp_context=mp_context,
+                                                initializer=_init_transform_worker, initargs=(lookup_maps,)) as pool:
+        futures = [pool.submit(_transform_block, df_block, offset, parsed_block)
+                   for _, df_block, offset, parsed_block in blocks]
+        results = [future.result() for future in futures]
+
+    if edits is not None:
+        for (start, *_), (_, _, block_edits) in zip(blocks, results):
+            edits.extend((positions + start, col_idx) for positions, col_idx in block_edits)
+    # Blocks of one Arrow column may come back with different dtypes (a write turns only its own block
+    # to object), and concatenating those gives pd.NA for blanks; back on numpy dtypes they concat as one
+    return (pd.concat([to_numpy_frame(df_processed) for df_processed, _, _ in results]),
+            any(modified for _, modified, _ in results))
+
+
+def map_isolated(function, arg_tuples, max_workers):
+    """[(result, None) or (None, exception)] of function(*args) for every args tuple, in order.
+
+    One failing call doesn't stop the others; with max_workers <= 1 (or a single call) they run here.
+    function must be importable by name, since workers are spawned.
+    """
+    if max_workers <= 1 or len(arg_tuples) <= 1:
+        outcomes = []
+        for args in arg_tuples:
+            try:
+                outcomes.append((function(*args), None))
+            except Exception as e:
+                outcomes.append((None, e))
+        return outcomes
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(arg_tuples)),
+                                                mp_context=mp_context) as pool:
+        futures = [pool.submit(function, *args) for args in arg_tuples]
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append((future.result(), None))
+            except Exception as e:  # includes a worker that died (BrokenProcessPool)
+                outcomes.append((None, e))
+        return outcomes
@@ -0,0 +1,151 @@
+import io
+import re
+import math
+import posixpath
+import numbers
+import zipfile
+import collections
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+# Patch output mode: instead of regenerating the workbook, the cells the transform wrote
+# are spliced into the original first worksheet's XML. Untouched rows, other sheets, styles
+# and column formats are copied byte for byte. Sheet row N+2 holds DataFrame row N, which is
+# how pd.read_excel(header=0) maps them. Anything the patcher can't represent faithfully
+# raises PatchNotSupported so the caller can fall back to a full rewrite.
+
+_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+_ROW_RE = re.compile(rb'<row\b[^>]*?/>|<row\b[^>]*>.*?</row>', re.DOTALL)
+_CELL_RE = re.compile(rb'<c\b[^>]*?/>|<c\b[^>]*>.*?</c>', re.DOTALL)
+_ROW_NUMBER_RE = re.compile(rb'\br="(\d+)"')
+_CELL_REF_RE = re.compile(rb'\br="([A-Z]+)(\d+)"')
+_STYLE_RE = re.compile(rb'\bs="(\d+)"')
+_SPANS_RE = re.compile(rb'\s+spans="[^"]*"')
+_ILLEGAL_XML_CHARS_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class PatchNotSupported(ValueError):
+    pass
+
+
+def first_worksheet_path(zf):
+    workbook = ET.fromstring(zf.read('xl/workbook.xml'))
+    sheet = workbook.find(f'{{{_MAIN_NS}}}sheets/{{{_MAIN_NS}}}sheet')
+    if sheet is None: raise PatchNotSupported("workbook has no sheets")
+    rel_id = sheet.get(f'{{{_REL_NS}}}id')
+    rels = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    for rel in rels.iter(f'{{{_PKG_REL_NS}}}Relationship'):
+        if rel.get('Id') == rel_id:
+            target = rel.get('Target')
+            return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+    raise PatchNotSupported("first sheet relationship not found")
+
+
+def _cell_xml(ref, style, value):
+    style_attr = f' s="{style.decode()}"' if style else ""
+    if value is None or value != value:  # None, NaN and NaT all become blank cells
+        return f'<c r="{ref}"{style_attr}/>'.encode()
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'.encode()
+    if isinstance(value, numbers.Integral):
+        return f'<c r="{ref}"{style_attr}><v>{int(value)}</v></c>'.encode()
+    if isinstance(value, numbers.Real):
+        if math.isinf(value): raise PatchNotSupported(f"infinite value in {ref}")
+        return f'<c r="{ref}"{style_attr}><v>{float(value)!r}</v></c>'.encode()
+    if isinstance(value, str):
+        text = escape(_ILLEGAL_XML_CHARS_RE.sub("", value))
+        return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'.encode()
+    raise PatchNotSupported(f"can't write {type(value).__name__} into {ref} without its number format")
+
+
+def _patch_row(row_xml, row_number, new_cells):
+    # new_cells: {col_idx: value}; returns the row with those cells replaced or inserted in order
+    if row_xml is None:
+        start_tag, body = f'<row r="{row_number}">'.encode(), b""
+    elif row_xml.endswith(b'/>') and not row_xml.endswith(b'</row>'):
+        start_tag, body = row_xml[:-2].rstrip() + b'>', b""
+    else:
+        end_of_start = row_xml.index(b'>') + 1
+        start_tag, body = row_xml[:end_of_start], row_xml[end_of_start:-len(b'</row>')]
+    start_tag = _SPANS_RE.sub(b"", start_tag)  # spans is only a hint and may no longer be accurate
+
+    cells = {}
+    for cell_match in _CELL_RE.finditer(body):
+        cell_xml = cell_match.group(0)
+        ref = _CELL_REF_RE.search(cell_xml[:cell_xml.index(b'>')])
+        if ref is None: raise PatchNotSupported(f"cell without a reference in row {row_number}")
+        cells[column_index_from_string(ref.group(1).decode()) - 1] = cell_xml
+    for col_idx, value in new_cells.items():
+        existing = cells.get(col_idx)
+        if existing is not None and b'<f' in existing:
+            raise PatchNotSupported(f"formula cell {get_column_letter(col_idx + 1)}{row_number} would be overwritten")
+        style = _STYLE_RE.search(existing[:existing.index(b'>')]) if existing is not None else None
+        cells[col_idx] = _cell_xml(f"{get_column_letter(col_idx + 1)}{row_number}", style and style.group(1), value)
+    return start_tag + b"".join(cells[ci] for ci in sorted(cells)) + b'</row>'
+
+
+def _patch_sheet_xml(sheet_xml, row_edits):
+    if b'<sheetData' not in sheet_xml: raise PatchNotSupported("worksheet uses a namespace prefix")
+    data_start = sheet_xml.index(b'<sheetData')
+    if sheet_xml.startswith(b'<sheetData/>', data_start):
+        head, rows_xml, tail = sheet_xml[:data_start], b"", sheet_xml[data_start + len(b'<sheetData/>'):]
+    else:
+        body_start = sheet_xml.index(b'>', data_start) + 1
+        body_end = sheet_xml.index(b'</sheetData>', body_start)
+        head, rows_xml, tail = sheet_xml[:data_start], sheet_xml[body_start:body_end], sheet_xml[body_end + 12:]
+
+    pending = sorted(row_edits)
+    out, pos, next_pending = [], 0, 0
+    for row_match in _ROW_RE.finditer(rows_xml):
+        number = _ROW_NUMBER_RE.search(row_match.group(0)[:row_match.group(0).index(b'>') + 1])
+        if number is None: raise PatchNotSupported("row without a row number")
+        row_number = int(number.group(1))
+        if next_pending < len(pending) and pending[next_pending] <= row_number:
+            out.append(rows_xml[pos:row_match.start()])
+            while next_pending < len(pending) and pending[next_pending] < row_number:
+                out.append(_patch_row(None, pending[next_pending], row_edits[pending[next_pending]]))
+                next_pending += 1
+            if next_pending < len(pending) and pending[next_pending] == row_number:
+                out.append(_patch_row(row_match.group(0), row_number, row_edits[row_number]))
+                next_pending += 1
+            else:
+                out.append(row_match.group(0))
+            pos = row_match.end()
+    out.append(rows_xml[pos:])
+    for row_number in pending[next_pending:]:
+        out.append(_patch_row(None, row_number, row_edits[row_number]))
+    return head + b'<sheetData>' + b"".join(out) + b'</sheetData>' + tail
+
+
+def collect_row_edits(df_processed, edits):
+    # (row_positions, col_idx) pairs from the transform -> {sheet_row: {col_idx: value}}
+    positions_by_col = collections.defaultdict(list)
+    for positions, col_idx in edits: positions_by_col[col_idx].extend(positions)
+    row_edits = collections.defaultdict(dict)
+    for col_idx, positions in positions_by_col.items():
+        for row_pos, value in zip(positions, df_processed.iloc[positions, col_idx].tolist()):
+            row_edits[int(row_pos) + 2][col_idx] = value
+    return row_edits
+
+
+def patch_workbook(data, df_processed, edits):
+    """Return the original .xlsx bytes with only the edited cells of the first sheet rewritten."""
+    row_edits = collect_row_edits(df_processed, edits)
+    output_buffer = io.BytesIO()
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as zin, \
+                zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_DEFLATED) as zout:
+            sheet_path = first_worksheet_path(zin)
+            for item in zin.infolist():
+                if item.filename == sheet_path:
+                    zout.writestr(item, _patch_sheet_xml(zin.read(item.filename), row_edits), zipfile.ZIP_DEFLATED)
+                else:
+                    zout.writestr(item, zin.read(item.filename))
+    except (KeyError, ET.ParseError, zipfile.BadZipFile) as e:
+        raise PatchNotSupported(f"unexpected workbook structure: {e}") from e
+    return output_buffer.getvalue()
@@ -0,0 +1,195 @@
+import io
+import os
+import re
+import html
+import time
+import zipfile
+import collections
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from openpyxl.reader.strings import read_string_table
+from openpyxl.utils import get_column_letter
+
+from batch import DEFAULT_MAX_WORKERS, run_batch
+from patching import first_worksheet_path
+from processing import FILENAME_COL_IDX, RULES, TRACK_TITLE_COL_IDX, count_rule_rows, index_to_excel_col
+from tables import is_table_file, read_table_bytes
+
+# Pre-flight check: a quick look at every uploaded file before the full pass. For .xlsx only
+# the header row and the column B / R cells of the first sheet are decoded (straight from the
+# sheet XML, without building a workbook), for Parquet only those two columns; .xls and CSV
+# files are read whole. The report predicts what processing will do, so files that would fail
+# or do nothing can be dropped up front.
+
+# status 'ok', 'warning' (processable, but something looks off) or 'error' (will fail or can't
+# be read); message lists the findings; counts are processing.RuleRowCounts fields
+PreflightReport = collections.namedtuple('PreflightReport', [
+    'name', 'status', 'n_cols', 'n_rows', 'filename_rows', 'stem_rows', 'title_fills', 'changed_rows', 'message',
+    'seconds'])
+REPORT_COLUMNS = list(PreflightReport._fields)
+
+_ROW_START_RE = re.compile(rb'<row\b[^>]*?\br="(\d+)"')
+_CELL_RE = re.compile(rb'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.DOTALL)
+_CELL_REF_RE = re.compile(rb'\br="([A-Z]+)(\d+)"')
+_CELL_TYPE_RE = re.compile(rb'\bt="(\w+)"')
+_VALUE_RE = re.compile(rb'<v>(.*?)</v>', re.DOTALL)
+_TEXT_RE = re.compile(rb'<t\b[^>]*>(.*?)</t>', re.DOTALL)
+_PHONETIC_RE = re.compile(rb'<rPh\b.*?</rPh>', re.DOTALL)
+_ESCAPED_CHAR_RE = re.compile(r'_x([0-9A-Fa-f]{4})_')
+
+
+def _target_cell_re(col_indices):
+    letters = b"|".join(get_column_letter(ci + 1).encode() for ci in col_indices)
+    # The lookahead keeps the scan in C: only cells of the wanted columns become matches
+    return re.compile(rb'<c\b(?=[^>]*?\br="(' + letters + rb')(\d+)")([^>]*?)(?:/>|>(.*?)</c>)', re.DOTALL)
+
+
+def _text(raw):
+    return _ESCAPED_CHAR_RE.sub(lambda m: chr(int(m.group(1), 16)), html.unescape(raw.decode('utf-8')))
+
+
+def _cell_value(attrs, body, shared_strings):
+    # The value pd.read_excel would give the cell (dates stay serial numbers; close enough here)
+    cell_type = _CELL_TYPE_RE.search(attrs)
+    cell_type = cell_type.group(1) if cell_type else b'n'
+    if body is None: return None
+    if cell_type == b'inlineStr':
+        return _text(b"".join(_TEXT_RE.findall(_PHONETIC_RE.sub(b"", body))))
+    value = _VALUE_RE.search(body)
+    if value is None: return None
+    raw = value.group(1)
+    if cell_type == b's': return shared_strings[int(raw)]
+    if cell_type in (b'str', b'inlineStr'): return _text(raw)
+    if cell_type == b'b': return bool(int(raw))
+    if cell_type == b'e': return np.nan
+    number = float(raw)
+    return int(number) if number.is_integer() else number
+
+
+def _last_data_row(sheet_xml):
+    # Sheet row number of the last row holding any value (trailing formatted-only rows don't count)
+    starts = [(m.start(), int(m.group(1))) for m in _ROW_START_RE.finditer(sheet_xml)]
+    end = len(sheet_xml)
+    for start, row_number in reversed(starts):
+        if b'<v>' in sheet_xml[start:end] or b'<is>' in sheet_xml[start:end]: return row_number
+        end = start
+    return 0
+
+
+def read_key_columns_xlsx(data, col_indices):
+    """(header width, data rows, {col_idx: [values per data row]}) of the first sheet of an .xlsx."""
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        sheet_xml = zf.read(first_worksheet_path(zf))
+        string_table = []
+        if 'xl/sharedStrings.xml' in zf.namelist():
+            with zf.open('xl/sharedStrings.xml') as f: string_table = read_string_table(f)
+    if b'<sheetData' not in sheet_xml: raise ValueError("worksheet XML uses a namespace prefix")
+
+    first_row = _ROW_START_RE.search(sheet_xml)
+    header_width = 0
+    if first_row is not None and first_row.group(1) == b'1':
+        row_end = sheet_xml.find(b'</row>', first_row.end())
+        for cell in _CELL_RE.finditer(sheet_xml, first_row.start(), row_end if row_end >= 0 else len(sheet_xml)):
+            ref = _CELL_REF_RE.search(cell.group(1))
+            if ref and _cell_value(cell.group(1), cell.group(2), string_table) not in (None, ""):
+                header_width = max(header_width, _column_index(ref.group(1)) + 1)
+
+    n_rows = max(_last_data_row(sheet_xml) - 1, 0)
+    columns = {ci: [None] * n_rows for ci in col_indices}
+    for cell in _target_cell_re(col_indices).finditer(sheet_xml):
+        row_pos = int(cell.group(2)) - 2  # sheet row 2 is data row 0
+        if 0 <= row_pos < n_rows:
+            columns[_column_index(cell.group(1))][row_pos] = _cell_value(cell.group(3), cell.group(4), string_table)
+    return header_width, n_rows, columns
+
+
+def _column_index(letters):
+    index = 0
+    for char in letters: index = index * 26 + (char - ord('A') + 1)
+    return index - 1
+
+
+def read_key_columns_parquet(data, col_indices):
+    # Parquet stores columns separately: only B and R are decoded
+    parquet_file = pq.ParquetFile(io.BytesIO(data))
+    names = parquet_file.schema_arrow.names
+    present = [ci for ci in col_indices if ci < len(names)]
+    table = parquet_file.read(columns=[names[ci] for ci in present]) if present else None
+    return len(names), parquet_file.metadata.num_rows, {ci: table.column(k).to_pylist() for k, ci in enumerate(present)}
+
+
+def read_key_columns(name, data, col_indices):
+    if name.lower().endswith('.xlsx'): return read_key_columns_xlsx(data, col_indices)
+    if name.lower().endswith('.parquet'): return read_key_columns_parquet(data, col_indices)
+    if is_table_file(name):  # CSV: no way to skip columns without parsing every line anyway
+        df = read_table_bytes(name, data)
+        present = [ci for ci in col_indices if ci < df.shape[1]]
+        return df.shape[1], len(df), {ci: df.iloc[:, ci].tolist() for ci in present}
+    header = pd.read_excel(io.BytesIO(data), engine='xlrd', header=0, nrows=0)
+    present = [ci for ci in col_indices if ci < header.shape[1]]
+    df = pd.read_excel(io.BytesIO(data), engine='xlrd', header=0, usecols=present)
+    return header.shape[1], len(df), {ci: df.iloc[:, k].tolist() for k, ci in enumerate(present)}
+
+
+def _missing_roles(n_cols):
+    roles = RULES.columns._asdict()
+    missing = []
+    for role, col in roles.items():
+        for ci in (col if isinstance(col, tuple) else (col,)):
+            if ci >= n_cols: missing.append(f"{index_to_excel_col(ci)} ({role.replace('_', ' ')})")
+    return missing
+
+
+def preflight_file(name, data, progress=None):
+    """Predict what processing will do to one file from its header and columns B / R."""
+    started = time.perf_counter()
+    try:
+        n_cols, n_rows, columns = read_key_columns(name, data, (FILENAME_COL_IDX, TRACK_TITLE_COL_IDX))
+        # Only B and R are filled in; count_rule_rows reads nothing else
+        width = min(n_cols, max(FILENAME_COL_IDX, TRACK_TITLE_COL_IDX) + 1)
+        frame = pd.DataFrame({ci: columns[ci] if ci in columns else [None] * n_rows for ci in range(width)},
+                             index=range(n_rows), dtype=object)
+        counts = count_rule_rows(frame)
+    except Exception as e:
+        return PreflightReport(os.path.basename(name), 'error', 0, 0, 0, 0, 0, 0,
+                               f"Can't read {os.path.basename(name)}: {e}", time.perf_counter() - started)
+
+    status, findings = 'ok', []
+    if n_rows == 0:
+        status = 'warning'; findings.append("no data rows")
+    if FILENAME_COL_IDX >= n_cols:
+        status = 'warning'; findings.append(f"no filename column {index_to_excel_col(FILENAME_COL_IDX)}: "
+                                            f"the file will be left unchanged")
+    elif TRACK_TITLE_COL_IDX >= n_cols and counts.title_fills:
+        status = 'error'; findings.append(f"{counts.title_fills} row(s) need a title but the sheet has no column "
+                                          f"{index_to_excel_col(TRACK_TITLE_COL_IDX)}; processing will fail")
+    elif counts.filename_rows and not counts.changed_rows:
+        findings.append("no STEM rows or missing titles: only row numbers can change")
+    missing = _missing_roles(n_cols) if FILENAME_COL_IDX < n_cols else []
+    if missing:
+        if status == 'ok': status = 'warning'
+        findings.append(f"only {n_cols} column(s); rules for {', '.join(missing)} are skipped")
+    return PreflightReport(os.path.basename(name), status, n_cols, n_rows, *counts, "; ".join(findings),
+                           time.perf_counter() - started)
+
+
+def preflight_path(path, progress=None):
+    try:
+        with open(path, 'rb') as f: data = f.read()
+    except OSError as e:
+        return PreflightReport(os.path.basename(path), 'error', 0, 0, 0, 0, 0, 0, f"Can't read {path}: {e}", 0.0)
+    return preflight_file(path, data, progress)
+
+
+def run_preflight(files, max_workers=DEFAULT_MAX_WORKERS, on_result=None):
+    """preflight_file for every (name, bytes) pair in parallel; reports come back in input order."""
+    return run_batch([(name, data) for name, data, *_ in files], max_workers, on_result, worker=preflight_file)
+
+
+def report_frame(reports):
+    # The worker-crash fallback of run_batch is a FileResult; show it as an error row
+    return pd.DataFrame([r._asdict() if isinstance(r, PreflightReport) else
+                         PreflightReport(r.name, 'error', 0, 0, 0, 0, 0, 0, r.message, 0.0)._asdict()
+                         for r in reports], columns=REPORT_COLUMNS)
@@ -0,0 +1,664 @@
+import os
+import io
+import re
+import heapq
+import functools
+import collections
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from openpyxl.utils import get_column_letter
+
+from rules import active_rule_plan, index_to_excel_col
+
+# Core transform rules for XL MASTER. Kept free of any Streamlit import so the
+# same code can be reused by the UI and by headless tooling.
+
+# --- Configuration ---
+# The rules are data (rules.json, validated and compiled by rules.py); RULES is the plan this
+# process applies, compiled once at import and shared by every rerun, session and chunk.
+RULES = active_rule_plan()
+RULES_VERSION = RULES.version
+FILENAME_COL_IDX = RULES.columns.filename
+TRACK_TITLE_COL_IDX = RULES.columns.track_title
+EXCLUDED_COL_INDICES = list(RULES.excluded_cols)
+INSTRUMENT_KEYWORD_MAP = RULES.instruments.keyword_map
+
+
+# --- Filename Decomposition ---
+# A column-B filename such as "ALB001_03_My Title_STEMLeadVocal.wav" is split once
+# into every field the rules need; the get_* helpers below are thin wrappers.
+ParsedFilename = collections.namedtuple(
+    'ParsedFilename', ['base_name', 'title', 'track_number', 'e_prefix', 'raw_stem', 'formatted_stem'])
+
+PARSED_FILENAME_FIELDS = list(ParsedFilename._fields)
+_STEM_SUFFIX_RE = re.compile(r"_STEM(.*)")
+_TITLE_SUFFIXES = ("_STEM", "_Full")
+
+
+def format_extracted_stem_part(stem_raw):
+    if not stem_raw or not isinstance(stem_raw, str): return ""
+    txt = str(stem_raw)
+    txt = re.sub(r"([a-z\d])([A-Z])", r"\1 \2", txt)
+    txt = re.sub(r"([A-Z])([A-Z][a-z])", r"\1 \2", txt)
+    txt = re.sub(r"([A-Za-z])(\d)", r"\1 \2", txt)
+    return re.sub(r'\s+', ' ', txt).strip()
+
+
+def _title_from_name(name_without_ext):
+    name_for_title_extraction = name_without_ext
+    for suffix_base in _TITLE_SUFFIXES:
+        if suffix_base in name_for_title_extraction:
+            name_for_title_extraction = name_for_title_extraction.split(suffix_base)[0]
+            break
+    parts = name_for_title_extraction.split('_')
+    if len(parts) >= 3:
+        title = "_".join(parts[2:]); return title.strip() if title else None
+    elif len(parts) == 2:
+        return parts[1].strip() if parts[1] else None
+    elif len(parts) == 1 and name_for_title_extraction.strip():
+        return name_for_title_extraction.strip()
+    return None
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_filename(fn_str):
+    name_without_ext, _ = os.path.splitext(fn_str)
+    parts = name_without_ext.split('_')
+
+    m = _STEM_SUFFIX_RE.search(name_without_ext)
+    raw_stem = m.group(1) if m and m.group(1) else None
+
+    return ParsedFilename(
+        base_name=name_without_ext,
+        title=_title_from_name(name_without_ext) if fn_str.strip() else None,
+        track_number=parts[1] if len(parts) >= 2 else "",
+        e_prefix="_".join(parts[:2]),
+        raw_stem=raw_stem,
+        formatted_stem=format_extracted_stem_part(raw_stem),
+    )
+
+
+def parse_filename_column(filenames):
+    # Parses each distinct filename once and broadcasts the fields back to every row
+    codes, uniques = pd.factorize(pd.Series(filenames, dtype=object))
+    parsed = pd.DataFrame([parse_filename(fn) for fn in uniques], columns=PARSED_FILENAME_FIELDS)
+    return parsed.take(codes).reset_index(drop=True)
+
+
+def get_raw_stem_part_from_filename(fn_str):
+    if not fn_str or not isinstance(fn_str, str): return None
+    return parse_filename(fn_str).raw_stem
+
+
+def extract_main_title_from_filename_robust(fn_str):
+    if not isinstance(fn_str, str) or not fn_str.strip(): return None
+    return parse_filename(fn_str).title
+
+
+def get_track_number_from_filename(fn_str):
+    if not isinstance(fn_str, str) or not fn_str.strip(): return ""
+    return parse_filename(fn_str).track_number
+
+
+def get_col_E_value_from_filename(fn_str):
+    if not isinstance(fn_str, str) or not fn_str.strip(): return ""
+    return parse_filename(fn_str).e_prefix
+
+
+# --- Arrow Kernels ---
+# parse_filename() and the lyrics rewrite re-expressed as pyarrow.compute kernels for sheets
+# loaded with Arrow dtypes. RE2's \d \s \w are ASCII-only and its case folding differs, so
+# character classes are spelled out from what Python's re itself matches; every kernel returns
+# exactly what the Python function returns for the same str.
+
+@functools.lru_cache(maxsize=None)
+def _python_char_class(pattern):
+    # Body of an RE2 [...] class with the code points the one-character Python pattern matches
+    text = "".join(map(chr, range(0xD800))) + "".join(map(chr, range(0xE000, 0x110000)))  # no surrogates in UTF-8
+    ranges = []
+    for m in re.finditer(f"(?:{pattern})+", text):
+        first, last = (i if i < 0xD800 else i + 0x800 for i in (m.start(), m.end() - 1))
+        ranges.append(f"\\x{{{first:X}}}" if first == last else f"\\x{{{first:X}}}-\\x{{{last:X}}}")
+    return "".join(ranges)
+
+
+def _arrow_replace(values, pattern, replacement):
+    return pc.replace_substring_regex(values, pattern=pattern, replacement=replacement)
+
+
+def parse_filename_arrow(filenames):
+    """parse_filename() for every str of a pyarrow string array; one row per element, same fields."""
+    encoded = pc.dictionary_encode(filenames)
+    fn = encoded.dictionary  # each distinct filename is parsed once
+    ws, digit = _python_char_class(r"\s"), _python_char_class(r"\d")
+    null_str = pa.scalar(None, pa.string())
+
+    base = _arrow_replace(fn, r"(?s)^((?:.*/)?\.*[^./][^/]*)\.[^./]*$", r"\1")  # os.path.splitext
+    has_underscore = pc.greater(pc.count_substring(base, "_"), 0)
+    track = pc.if_else(has_underscore, _arrow_replace(base, r"(?s)^[^_]*_([^_]*).*$", r"\1"), "")
+    e_prefix = _arrow_replace(base, r"(?s)^([^_]*(?:_[^_]*)?).*$", r"\1")
+
+    stem = pc.if_else(pc.match_substring(base, "_STEM"), _arrow_replace(base, r"(?s)^.*?_STEM([^\n]*).*$", r"\1"), "")
+    raw_stem = pc.if_else(pc.equal(stem, ""), null_str, stem)
+    formatted = _arrow_replace(stem, f"([a-z{digit}])([A-Z])", r"\1 \2")
+    formatted = _arrow_replace(formatted, r"([A-Z])([A-Z][a-z])", r"\1 \2")
+    formatted = _arrow_replace(formatted, f"([A-Za-z])([{digit}])", r"\1 \2")
+    formatted = pc.utf8_trim(_arrow_replace(formatted, f"[{ws}]+", " "), characters=" ")
+
+    title_source = pc.if_else(
+        pc.match_substring(base, "_STEM"), _arrow_replace(base, r"(?s)_STEM.*", ""),
+        pc.if_else(pc.match_substring(base, "_Full"), _arrow_replace(base, r"(?s)_Full.*", ""), base))
+    rest = _arrow_replace(title_source, r"(?s)^[^_]*_(?:[^_]*_)?", "")  # text after the 2nd (or only) '_'
+    stripped = _arrow_replace(rest, f"^[{ws}]+|[{ws}]+$", "")
+    # An empty remainder after an underscore gives None; a whitespace-only one gives ""
+    title = pc.if_else(pc.not_equal(stripped, ""), stripped, pc.if_else(
+        pc.and_(pc.greater(pc.count_substring(title_source, "_"), 0), pc.not_equal(rest, "")), "", null_str))
+    title = pc.if_else(pc.match_substring_regex(fn, f"^[{ws}]*$"), null_str, title)
+
+    parsed = pd.DataFrame({field: values.to_numpy(zero_copy_only=False) for field, values in zip(
+        PARSED_FILENAME_FIELDS, [base, title, track, e_prefix, raw_stem, formatted])}, dtype=object)
+    return parsed.take(encoded.indices.to_numpy()).reset_index(drop=True)
+
+
+def rewrite_word_arrow(values, word, replacement):
+    # re.sub(r'\bWORD\b', replacement, v, flags=re.IGNORECASE, count=1) for each str in values
+    if not values: return []
+    word_char = _python_char_class(r"\w")
+    letters = "".join(f"[{_python_char_class('(?i:' + re.escape(char) + ')')}]" for char in word)
+    return pc.replace_substring_regex(pa.array(values, type=pa.string()),
+                                      pattern=f"(^|[^{word_char}]){letters}($|[^{word_char}])",
+                                      replacement=rf"\1{replacement}\2", max_replacements=1).to_pylist()
+
+
+def blank_text_mask_arrow(values):
+    # True where a string cell is null or str.strip() would leave nothing
+    ws = _python_char_class(r"\s")
+    return pc.fill_null(pc.match_substring_regex(values, f"^[{ws}]*$"), True).to_numpy(zero_copy_only=False)
+
+
+# --- Arrow-backed Frames ---
+# dtype_backend='pyarrow' keeps a sheet's all-text and numeric columns as Arrow arrays while it
+# is transformed. Columns mixing text with numbers stay object so no cell changes type, and
+# to_numpy_frame() restores the dtypes read_excel gives before anything is written.
+DTYPE_BACKENDS = ('numpy', 'pyarrow')
+
+
+def is_arrow_column(series):
+    return isinstance(series.dtype, pd.ArrowDtype)
+
+
+def _is_arrow_string(series):
+    return is_arrow_column(series) and pa.types.is_string(series.dtype.pyarrow_dtype)
+
+
+def to_arrow_frame(df):
+    df = df.copy(deep=False)
+    for ci in range(df.shape[1]):
+        series = df.iloc[:, ci]
+        if series.dtype.kind in 'fiub':
+            df.isetitem(ci, series.astype(pd.ArrowDtype(pa.from_numpy_dtype(series.dtype))))
+        elif series.dtype == object and pd.api.types.infer_dtype(series, skipna=True) == 'string':
+            try:
+                df.isetitem(ci, series.astype(pd.ArrowDtype(pa.string())))
+            except (pa.ArrowException, UnicodeEncodeError):
+                pass  # lone surrogates can't be stored as UTF-8; the column stays object
+    return df
+
+
+def numpy_column(series):
+    if not is_arrow_column(series): return series
+    arrow_type = series.dtype.pyarrow_dtype
+    if pa.types.is_floating(arrow_type) or (pa.types.is_integer(arrow_type) and series.hasnans):
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+    elif (pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type)) and not series.hasnans:
+        values = series.to_numpy(dtype=arrow_type.to_pandas_dtype())
+    else:
+        values = series.to_numpy(dtype=object, na_value=np.nan)
+    return pd.Series(values, index=series.index, name=series.name)
+
+
+def to_numpy_frame(df):
+    arrow_cols = [ci for ci in range(df.shape[1]) if is_arrow_column(df.iloc[:, ci])]
+    if not arrow_cols: return df
+    df = df.copy(deep=False)
+    for ci in arrow_cols: df.isetitem(ci, numpy_column(df.iloc[:, ci]))
+    return df
+
+
+def _is_nan(value):
+    return isinstance(value, float) and value != value
+
+
+def _arrow_accepts(arrow_type, values):
+    # Arrow setitem converts silently ("12" into double, 1 into string); only values of the
+    # column's own kind go in, anything else first turns the column back into numpy
+    if pa.types.is_string(arrow_type):
+        ok = lambda v: isinstance(v, str)
+    elif pa.types.is_floating(arrow_type):
+        ok = lambda v: isinstance(v, (float, int, np.floating, np.integer)) and not isinstance(v, (bool, np.bool_))
+    elif pa.types.is_integer(arrow_type):
+        ok = lambda v: isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_))
+    elif pa.types.is_boolean(arrow_type):
+        ok = lambda v: isinstance(v, (bool, np.bool_))
+    else:
+        return False
+    return all(ok(v) or _is_nan(v) for v in values)
+
+
+# --- Column Widths ---
+# Widths are derived from the data before writing instead of rescanning the written sheet:
+# longest str() of the header and of every truthy cell, plus 2, capped at MAX_COLUMN_WIDTH.
+MAX_COLUMN_WIDTH = 70
+
+
+def _column_text_length(series):
+    if series.dtype.kind in 'iufb':
+        values = series[series.notna() & (series != 0)]
+        return int(values.astype(str).str.len().max()) if len(values) else 0
+    values = series.dropna()
+    values = values[values.astype(bool)]
+    return int(values.map(str).str.len().max()) if len(values) else 0
+
+
+def max_text_lengths(df):
+    return [_column_text_length(df.iloc[:, ci]) for ci in range(df.shape[1])]
+
+
+def header_text_lengths(columns):
+    return [len(str(c)) if c else 0 for c in columns]
+
+
+def widths_from_lengths(lengths):
+    return [min(length + 2, MAX_COLUMN_WIDTH) for length in lengths]
+
+
+def compute_column_widths(df):
+    return widths_from_lengths(map(max, header_text_lengths(df.columns), max_text_lengths(df)))
+
+
+# --- Instrumentation ---
+@functools.lru_cache(maxsize=65536)
+def classify_instrument(fmt_stem):
+    fmt_stem_lower = fmt_stem.lower() if fmt_stem else ""
+    if not fmt_stem_lower: return ""
+    vocabulary = RULES.instruments
+    candidates = [m.group(1) for m in vocabulary.keyword_re.finditer(fmt_stem_lower)] if vocabulary.keyword_re else []
+    candidates += [k for k in vocabulary.substring_keywords if k in fmt_stem_lower]
+    if not candidates: return ""
+    return vocabulary.keyword_map[min(candidates, key=vocabulary.keyword_rank.__getitem__)]
+
+
+def classify_instrument_column(fmt_stems):
+    # Classifies each distinct stem once and broadcasts the result back to every row
+    codes, uniques = pd.factorize(pd.Series(fmt_stems, dtype=object))
+    labels = np.array([classify_instrument(f) for f in uniques] + [""], dtype=object)
+    return labels[codes].tolist()
+
+
+# --- Columnar Transform Engine ---
+# Every rule is applied as one masked assignment per column instead of one
+# iloc write per cell. Values are handed to pandas as plain Python lists so the
+# resulting dtypes and cell values match what the per-cell loop produced.
+
+def _object_values(series):
+    if is_arrow_column(series):
+        return pd.Series(series.to_numpy(dtype=object, na_value=np.nan), index=series.index)
+    return series.astype(object)
+
+
+def _text_series(series):
+    # str() of every non-null cell, NaN elsewhere (same test the row loop used)
+    return _object_values(series).map(str, na_action='ignore')
+
+
+def _has_value_mask(series):
+    if _is_arrow_string(series):
+        return pd.Series(~blank_text_mask_arrow(pa.array(series)), index=series.index)
+    text = _text_series(series)
+    return series.notna() & text.map(lambda v: bool(v.strip()), na_action='ignore').astype('boolean').fillna(False).astype(bool)
+
+
+def _is_blank_cell(value):
+    return value is None or value is pd.NA or value is pd.NaT or _is_nan(value)
+
+
+def same_cell(old, new):
+    """True if writing new over old leaves the saved cell as it was.
+
+    Blanks (None/NaN/NA) are all the empty cell and 3 == 3.0 (Excel stores both as the same
+    number); text never equals a number and booleans only equal booleans.
+    """
+    if _is_blank_cell(old) or _is_blank_cell(new): return _is_blank_cell(old) and _is_blank_cell(new)
+    if isinstance(old, str) or isinstance(new, str): return isinstance(old, str) and isinstance(new, str) and old == new
+    if isinstance(old, (bool, np.bool_)) != isinstance(new, (bool, np.bool_)): return False
+    try:
+        return bool(old == new)
+    except (TypeError, ValueError):
+        return False
+
+
+def _upcast_dtype(dtype, values):
+    # The dtype a numpy column takes on when values are set into it: bool only holds bools
+    values_dtype = pd.Series(values).dtype
+    if values_dtype == dtype: return dtype
+    if dtype.kind == 'b' or not isinstance(values_dtype, np.dtype): return np.dtype(object)
+    return np.result_type(dtype, values_dtype)
+
+
+def _assign_column(df, positions, col_idx, values, edits=None):
+    # Writes only the values that differ from the cell they replace; returns how many that was
+    if col_idx >= df.shape[1] or len(positions) == 0: return 0
+    column = df.iloc[:, col_idx]
+    positions = np.asarray(positions)
+    changed = [j for j, (old, new) in enumerate(zip(column.iloc[positions].tolist(), values)) if not same_cell(old, new)]
+    if not changed: return 0
+    if len(changed) < len(values):
+        positions, values = positions[changed], [values[j] for j in changed]
+    if is_arrow_column(column) and not _arrow_accepts(column.dtype.pyarrow_dtype, values):
+        column = numpy_column(column)
+        df.isetitem(col_idx, column)
+    if not is_arrow_column(column) and column.dtype != object:
+        # Upcast explicitly, as setitem would (it warns about this and pandas 3 refuses)
+        target = _upcast_dtype(column.dtype, values)
+        if target != column.dtype: df.isetitem(col_idx, column.astype(target))
+    df.iloc[positions, col_idx] = values
+    if edits is not None: edits.append((positions, col_idx))
+    return len(positions)
+
+
+def _renumber_column(df, col_idx, has_filename, counter, edits=None):
+    # Running 1..n over rows that carry a filename; only rewrites cells whose str() differs
+    if col_idx >= df.shape[1]: return 0
+    current = df.iloc[:, col_idx]
+    already_ok = current.notna() & _text_series(current).eq(counter.astype(str))
+    needs_update = (has_filename & ~already_ok).to_numpy()
+    positions = np.flatnonzero(needs_update)
+    return _assign_column(df, positions, col_idx, counter.to_numpy()[positions].tolist(), edits)
+
+
+def parse_filename_cells(df_original):
+    # Decomposes every non-null column-B cell in one pass; index = row position
+    if FILENAME_COL_IDX >= df_original.shape[1]:
+        return pd.DataFrame(columns=PARSED_FILENAME_FIELDS, dtype=object)
+    fn_col = df_original.iloc[:, FILENAME_COL_IDX]
+    positions = np.flatnonzero(fn_col.notna().to_numpy())
+    if _is_arrow_string(fn_col):
+        parsed = parse_filename_arrow(pa.array(fn_col.iloc[positions]))
+    else:
+        parsed = parse_filename_column(_text_series(fn_col.iloc[positions]).tolist())
+    parsed.index = positions
+    return parsed
+
+
+def build_lookup_maps(df_original, parsed_filenames=None):
+    """(title -> first source row, title -> first track number) for a sheet or block of rows.
+
+    Source rows are the ndarray rows iterrows() would have yielded (df.values), so copied
+    cells keep the exact values the row loop copied.
+    """
+    n_cols = df_original.shape[1]
+    source_title_map_for_generic_copy = {}
+    if TRACK_TITLE_COL_IDX < n_cols:
+        r_titles = _text_series(df_original.iloc[:, TRACK_TITLE_COL_IDX]).map(str.strip, na_action='ignore')
+        positions = np.flatnonzero((r_titles.notna() & r_titles.ne("")).to_numpy())
+        r_titles = r_titles.iloc[positions]
+        first = ~r_titles.duplicated(keep='first').to_numpy()
+        source_rows = to_numpy_frame(df_original.iloc[positions[first]]).to_numpy()
+        source_title_map_for_generic_copy = dict(zip(r_titles.iloc[first].tolist(), source_rows))
+
+    # First track number per filename title; rows without a track number don't claim the title
+    if parsed_filenames is None: parsed_filenames = parse_filename_cells(df_original)
+    titles = parsed_filenames['title'].fillna("")
+    with_track = parsed_filenames[(titles != "") & (parsed_filenames['track_number'] != "")]
+    first_tracks = with_track.drop_duplicates(subset='title', keep='first')
+    main_title_to_first_original_track_no_map = dict(zip(first_tracks['title'], first_tracks['track_number']))
+    return source_title_map_for_generic_copy, main_title_to_first_original_track_no_map
+
+
+def _source_table(source_rows):
+    # Stacks source rows (possibly of different widths after streaming) into one object
+    # matrix for bulk takes; widths[k] says which columns row k really has.
+    widths = np.array([len(row) for row in source_rows], dtype=np.int64)
+    table = np.full((len(source_rows), int(widths.max(initial=0))), None, dtype=object)
+    for k, row in enumerate(source_rows): table[k, :len(row)] = row
+    return table, widths
+
+
+@functools.lru_cache(maxsize=None)
+def copy_columns(n_cols):
+    # Columns a filled row copies from its title's source row, for sheets n_cols wide
+    return tuple(ci for ci in range(n_cols) if ci not in RULES.copy_excluded)
+
+
+# What the rules will touch, judged from columns B and R alone (see preflight.py)
+RuleRowCounts = collections.namedtuple('RuleRowCounts', ['filename_rows', 'stem_rows', 'title_fills', 'changed_rows'])
+
+
+def count_rule_rows(df_original):
+    """Filename rows, STEM rows, blank-R rows that get a title, and rows Steps 2/3 will write.
+
+    A/AE renumbering is not included; it depends on columns the count doesn't read.
+    """
+    n_cols = df_original.shape[1]
+    if FILENAME_COL_IDX >= n_cols: return RuleRowCounts(0, 0, 0, 0)
+    has_filename = _has_value_mask(df_original.iloc[:, FILENAME_COL_IDX]).to_numpy()
+    parsed = parse_filename_cells(df_original).loc[np.flatnonzero(has_filename)]
+    has_stem = parsed['raw_stem'].notna().to_numpy()
+    titled = parsed['title'].fillna("").ne("").to_numpy()
+    if TRACK_TITLE_COL_IDX < n_cols:
+        title_blank = ~_has_value_mask(df_original.iloc[:, TRACK_TITLE_COL_IDX]).to_numpy()[has_filename]
+    else:
+        title_blank = np.ones(len(parsed), dtype=bool)
+    fills = titled & title_blank
+    return RuleRowCounts(len(parsed), int(has_stem.sum()), int(fills.sum()), int((has_stem | fills).sum()))
+
+
+def count_filename_rows(df_original):
+    # Rows that take part in A/AE numbering; the counter offset for the next block of rows
+    if FILENAME_COL_IDX >= df_original.shape[1]: return 0
+    return int(_has_value_mask(df_original.iloc[:, FILENAME_COL_IDX]).sum())
+
+
+def merge_lookup_maps(lookup_maps, chunk_lookup_maps):
+    # Folds the maps of a later block of rows into the sheet-wide maps; first match still wins
+    for target, source in zip(lookup_maps, chunk_lookup_maps):
+        for key, value in source.items(): target.setdefault(key, value)
+    return lookup_maps
+
+
+def transform_dataframe(df_original, edits=None):
+    """Apply all XL MASTER rules to a sheet. Returns (df_processed, file_was_modified).
+
+    Only cells whose value actually changes are written, so file_was_modified is False for a
+    sheet that is already processed. If edits is a list, (row_positions, col_idx) pairs are
+    appended for every cell written.
+    """
+    if FILENAME_COL_IDX >= df_original.shape[1] or df_original.shape[0] == 0:
+        return df_original.copy(), False
+    parsed_filenames = parse_filename_cells(df_original)
+    lookup_maps = build_lookup_maps(df_original, parsed_filenames)
+    return transform_chunk(df_original, lookup_maps, 0, parsed_filenames, edits)
+
+
+def transform_chunk(df_original, lookup_maps, counter_offset=0, parsed_filenames=None, edits=None):
+    """Apply the rules to a block of consecutive rows of a sheet.
+
+    lookup_maps comes from build_lookup_maps() over the whole sheet and counter_offset is
+    the number of filename rows above the block, so blocks can be transformed one at a time.
+    """
+    n_rows, n_cols = df_original.shape
+    df_processed = df_original.copy()
+    if FILENAME_COL_IDX >= n_cols or n_rows == 0:
+        return df_processed, False
+    if edits is None: edits = []
+    edits_before = len(edits)  # the block is modified if any _assign_column below writes a cell
+
+    cols, vocal_rules = RULES.columns, RULES.vocal
+    has_filename = _has_value_mask(df_original.iloc[:, FILENAME_COL_IDX])
+    arrow_kernels = is_arrow_column(df_original.iloc[:, FILENAME_COL_IDX])
+    counter = has_filename.astype(np.int64).cumsum() + counter_offset
+
+    # --- Row number columns (A / AE): running row numbers ---
+    for col_idx in cols.row_numbers:
+        _renumber_column(df_processed, col_idx, has_filename, counter, edits)
+
+    if parsed_filenames is None: parsed_filenames = parse_filename_cells(df_original)
+    source_title_map_for_generic_copy, main_title_to_first_original_track_no_map = lookup_maps
+    cols_to_copy = copy_columns(n_cols)
+
+    fn_positions = np.flatnonzero(has_filename.to_numpy())
+    parsed = parsed_filenames.loc[fn_positions]
+    main_titles = parsed['title'].fillna("").tolist()
+    has_stem = parsed['raw_stem'].notna().to_numpy()
+
+    # --- Step 2: fill MISSING titles in Column R and copy metadata from the first source row ---
+    if TRACK_TITLE_COL_IDX < n_cols:
+        title_blank = ~_has_value_mask(df_original.iloc[:, TRACK_TITLE_COL_IDX]).to_numpy()[fn_positions]
+    else:
+        title_blank = np.ones(len(fn_positions), dtype=bool)
+    fill_idx = [i for i in range(len(fn_positions)) if main_titles[i] and title_blank[i]]
+    if fill_idx and TRACK_TITLE_COL_IDX >= n_cols:
+        raise IndexError(TRACK_TITLE_COL_IDX)
+
+    # One bulk take per column: each fill row is joined to its title's first source row
+    fill_idx = np.asarray(fill_idx, dtype=np.int64)
+    fill_positions = fn_positions[fill_idx]
+    fill_titles = [main_titles[i] for i in fill_idx]
+    _assign_column(df_processed, fill_positions, TRACK_TITLE_COL_IDX, fill_titles, edits)
+
+    matched_titles = [t for t in dict.fromkeys(fill_titles) if t in source_title_map_for_generic_copy]
+    src_table, src_widths = _source_table([source_title_map_for_generic_copy[t] for t in matched_titles])
+    fill_src = pd.Index(matched_titles, dtype=object).get_indexer(fill_titles) if len(fill_idx) else fill_idx
+    if len(matched_titles):
+        fill_widths = np.where(fill_src >= 0, src_widths[np.maximum(fill_src, 0)], 0)
+        for ctc_idx in cols_to_copy:
+            has_col = fill_widths > ctc_idx
+            _assign_column(df_processed, fill_positions[has_col], ctc_idx,
+                           src_table[fill_src[has_col], ctc_idx].tolist(), edits)
+
+    if cols.track_number < n_cols:
+        v_keep = [j for j, t in enumerate(fill_titles) if t in main_title_to_first_original_track_no_map]
+        _assign_column(df_processed, fill_positions[v_keep], cols.track_number,
+                       [main_title_to_first_original_track_no_map[fill_titles[j]] for j in v_keep], edits)
+
+    # Source row (index into src_table, -1 for none) of every filename row, for Step 3
+    row_src = np.full(len(fn_positions), -1, dtype=np.int64)
+    row_src[fill_idx] = fill_src
+
+    def source_values(src_rows, col_idx):
+        # [(j, value)] for rows j whose source row exists and is wide enough to have col_idx
+        return [(j, src_table[k, col_idx]) for j, k in enumerate(src_rows) if k >= 0 and src_widths[k] > col_idx]
+
+    # --- Step 3: populate columns for ALL STEM rows ---
+    stem_idx = np.flatnonzero(has_stem)
+    if len(stem_idx) == 0:
+        return df_processed, len(edits) > edits_before
+
+    stem_positions = fn_positions[stem_idx]
+    stem_parsed = parsed.iloc[stem_idx]
+    stem_titles = [main_titles[i] for i in stem_idx]
+    fmt_stems = stem_parsed['formatted_stem'].tolist()
+    fmt_stems_lower = [f.lower() for f in fmt_stems]
+    is_vocal = np.array([vocal_rules.stem_keyword in f for f in fmt_stems_lower], dtype=bool)
+    stem_src = row_src[stem_idx]
+
+    if cols.instrument < n_cols:
+        y_values = classify_instrument_column(fmt_stems)
+        y_keep = [j for j, v in enumerate(y_values) if v]
+        _assign_column(df_processed, stem_positions[y_keep], cols.instrument, [y_values[j] for j in y_keep], edits)
+
+    _assign_column(df_processed, stem_positions, cols.base_name, stem_parsed['base_name'].tolist(), edits)
+
+    if cols.stem_description < n_cols:
+        # The prefix (P) is read after Step 2, so copied source values are picked up as before
+        if cols.description_prefix < n_cols:
+            p_col = df_processed.iloc[stem_positions, cols.description_prefix]
+            p_values = [str(v) if pd.notna(v) else "" for v in p_col.tolist()]
+        else:
+            p_values = [""] * len(stem_positions)
+        _assign_column(df_processed, stem_positions, cols.stem_description,
+                       [f"{p} {tt} STEM {fs}".strip() for p, tt, fs in zip(p_values, stem_titles, fmt_stems)], edits)
+
+    _assign_column(df_processed, stem_positions, cols.e_prefix, stem_parsed['e_prefix'].tolist(), edits)
+    _assign_column(df_processed, stem_positions, cols.stem_label, [f"STEM {fs}".strip() for fs in fmt_stems], edits)
+
+    if cols.lyrics < n_cols:
+        t_values = [vocal_rules.lyrics_vocal if v else vocal_rules.lyrics_non_vocal for v in is_vocal]
+        t_sources = [(j, str(src_t)) for j, src_t in source_values(stem_src, cols.lyrics) if is_vocal[j]]
+        if arrow_kernels:
+            t_modified = rewrite_word_arrow([t for _, t in t_sources], vocal_rules.lyrics_rewrite_word,
+                                            vocal_rules.lyrics_rewrite_replacement)
+        else:
+            t_modified = [vocal_rules.lyrics_rewrite_re.sub(vocal_rules.lyrics_rewrite_replacement, t, count=1)
+                          for _, t in t_sources]
+        for (j, source_T_val_original), modified_T_val in zip(t_sources, t_modified):
+            if modified_T_val != source_T_val_original:
+                t_values[j] = modified_T_val
+            elif source_T_val_original.strip():
+                t_values[j] = source_T_val_original
+        _assign_column(df_processed, stem_positions, cols.lyrics, t_values, edits)
+
+    for col_idx, value in RULES.stem_constant_fills:
+        _assign_column(df_processed, stem_positions, col_idx, [value] * len(stem_positions), edits)
+
+    for col_idx in vocal_rules.source_cols:
+        if col_idx >= n_cols: continue
+        pairs = [(j, v) for j, v in source_values(stem_src, col_idx) if is_vocal[j]]
+        _assign_column(df_processed, stem_positions[[j for j, _ in pairs]], col_idx, [v for _, v in pairs], edits)
+
+    if cols.vocal_flag < n_cols:
+        _assign_column(df_processed, stem_positions, cols.vocal_flag,
+                       [vocal_rules.flag_vocal if v else vocal_rules.flag_non_vocal for v in is_vocal], edits)
+        if cols.vocal_description < n_cols:
+            bd_source = dict(source_values(stem_src, cols.vocal_description))
+            bd_keep, bd_values = [], []
+            for j, vocal in enumerate(is_vocal):
+                if not vocal:
+                    bd_keep.append(j); bd_values.append(vocal_rules.description_non_vocal)
+                elif fmt_stems_lower[j] in vocal_rules.background_stems:
+                    bd_keep.append(j); bd_values.append(vocal_rules.description_background)
+                elif j in bd_source:
+                    bd_keep.append(j); bd_values.append(bd_source[j])
+            _assign_column(df_processed, stem_positions[bd_keep], cols.vocal_description, bd_values, edits)
+
+    return df_processed, len(edits) > edits_before
+
+
+# --- Change Reports ---
+# A compact cell-level diff: the first DIFF_CELL_LIMIT changed cells of a file, in sheet order
+DIFF_CELL_LIMIT = 50
+CellChange = collections.namedtuple('CellChange', ['cell', 'old', 'new'])
+
+
+def _plain_value(value):
+    if _is_blank_cell(value): return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def cell_changes(df_original, df_processed, edits, limit=DIFF_CELL_LIMIT, first_row=0):
+    """CellChange for the first `limit` edited cells; first_row is the sheet position of a block's row 0."""
+    cells = heapq.nsmallest(limit, ((int(r), ci) for positions, ci in edits for r in positions))
+    return [CellChange(f"{index_to_excel_col(ci)}{first_row + r + 2}", _plain_value(df_original.iat[r, ci]),
+                       _plain_value(df_processed.iat[r, ci])) for r, ci in cells]
+
+
+def write_workbook(df_processed, fit_widths=True, widths=None):
+    # widths: precomputed compute_column_widths(df_processed), when the caller times it separately
+    return write_workbook_sheets([('Sheet1', df_processed, widths)], fit_widths)
+
+
+def write_workbook_sheets(sheets, fit_widths=True):
+    """One workbook from [(sheet name, frame, widths or None)], sheets in that order."""
+    output_buffer = io.BytesIO()
+    with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
+        for sheet_name, df_processed, widths in sheets:
+            df_processed.to_excel(writer, index=False, sheet_name=sheet_name)
+            if not fit_widths: continue
+            worksheet = writer.sheets[sheet_name]
+            if widths is None: widths = compute_column_widths(df_processed)
+            for ci, width in enumerate(widths):
+                worksheet.column_dimensions[get_column_letter(ci + 1)].width = width
+    return output_buffer.getvalue()
@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import types
+import hashlib
+import functools
+import collections
+
+import jsonschema
+
+# The transform's rules as data: rules.json (or the file named by XL_MASTER_RULES) holds the
+# column layout, the exclusions, the constant fills, the vocal rules and the instrument
+# vocabulary. A file is validated and compiled once per process into an immutable RulePlan;
+# processing.py reads the active plan at import, so Streamlit reruns and sessions share it.
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json')
+RULES_PATH_ENV = 'XL_MASTER_RULES'
+SCHEMA_VERSION = 1
+# Bump whenever the code applying a plan changes behaviour; rule file edits change the hash by themselves
+ENGINE_REVISION = 4
+
+SINGLE_COLUMN_ROLES = ('filename', 'track_title', 'stem_description', 'e_prefix', 'base_name', 'description_prefix',
+                       'stem_label', 'lyrics', 'track_number', 'instrument', 'vocal_flag', 'vocal_description')
+
+_LETTERS = {'type': 'string', 'pattern': '^[A-Za-z]{1,3}$'}
+_LETTER_LIST = {'type': 'array', 'items': _LETTERS, 'uniqueItems': True}
+_TEXT = {'type': 'string'}
+
+
+def _object(properties, required=None):
+    return {'type': 'object', 'properties': properties, 'required': list(required or properties),
+            'additionalProperties': False}
+
+
+RULES_SCHEMA = _object({
+    'schema_version': {'const': SCHEMA_VERSION},
+    'name': _TEXT,
+    'columns': _object({**{role: _LETTERS for role in SINGLE_COLUMN_ROLES}, 'row_numbers': _LETTER_LIST}),
+    'excluded_columns': _LETTER_LIST,
+    'stem_constant_fills': {'type': 'object', 'propertyNames': _LETTERS, 'additionalProperties': _TEXT},
+    'vocal_rules': _object({
+        'stem_keyword': {'type': 'string', 'minLength': 1},
+        # rewrite_word is replaced as a whole word, case-insensitively, once; the replacement is literal text
+        'lyrics': _object({'vocal': _TEXT, 'non_vocal': _TEXT, 'rewrite_word': {'type': 'string', 'pattern': r'^\w+$'},
+                           'rewrite_replacement': {'type': 'string', 'pattern': r'^[^\\]*$'}}),
+        'vocal_flag': _object({'vocal': _TEXT, 'non_vocal': _TEXT}),
+        'vocal_description': _object({'non_vocal': _TEXT, 'background_stems': {'type': 'array', 'items': _TEXT},
+                                      'background': _TEXT}),
+        'copy_from_source_when_vocal': _LETTER_LIST,
+    }),
+    'instruments': _object({
+        # Matched as whole words, longest first; substring_keywords match anywhere in the stem
+        'keywords': {'type': 'object', 'propertyNames': {'minLength': 1}, 'additionalProperties': _TEXT},
+        'substring_keywords': {'type': 'array', 'items': _TEXT},
+    }),
+}, required=['schema_version', 'columns', 'excluded_columns', 'stem_constant_fills', 'vocal_rules', 'instruments'])
+
+
+class RulesConfigError(ValueError):
+    """The rules file is missing, not JSON, or fails validation."""
+
+
+# --- Column Letters ---
+def excel_col_to_index(col_str):
+    if not isinstance(col_str, str) or not col_str.isalpha():
+        raise ValueError(f"Invalid Excel column letter: {col_str}")
+    index = 0;
+    col_str = col_str.upper()
+    for char in col_str: index = index * 26 + (ord(char) - ord('A') + 1)
+    return index - 1
+
+
+def index_to_excel_col(n):
+    n_orig = n;
+    n += 1;
+    string = ""
+    if n <= 0: return f"InvalidIndex({n_orig})"
+    while n > 0: n, rem = divmod(n - 1, 26); string = chr(65 + rem) + string
+    return string
+
+
+# --- Compiled Plan ---
+ColumnRoles = collections.namedtuple('ColumnRoles', SINGLE_COLUMN_ROLES + ('row_numbers',))
+VocalRules = collections.namedtuple('VocalRules', [
+    'stem_keyword', 'lyrics_vocal', 'lyrics_non_vocal', 'lyrics_rewrite_re', 'lyrics_rewrite_word',
+    'lyrics_rewrite_replacement', 'flag_vocal', 'flag_non_vocal', 'description_non_vocal', 'background_stems',
+    'description_background', 'source_cols'])
+InstrumentVocabulary = collections.namedtuple('InstrumentVocabulary', [
+    'keyword_map', 'keyword_rank', 'substring_keywords', 'keyword_re'])
+# Column indices are 0-based; excluded_cols and copy_excluded are never filled from a source row
+RulePlan = collections.namedtuple('RulePlan', [
+    'version', 'name', 'path', 'columns', 'excluded_cols', 'copy_excluded', 'stem_constant_fills', 'vocal',
+    'instruments'])
+
+
+def _trie_pattern(words):
+    # Prefix-trie alternation; at any start position the regex tries longer
+    # continuations first, so it yields the longest keyword matching there.
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word: node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches: return ""
+        alternation = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{alternation})?" if "" in node else alternation
+
+    return build(trie)
+
+
+def _compile_instruments(config):
+    keyword_map = config['keywords']
+    # Keywords are ranked longest first (ties keep file order); the best-ranked keyword
+    # found anywhere in the stem wins.
+    ranked = sorted(keyword_map, key=len, reverse=True)
+    substring_keywords = tuple(config['substring_keywords'])
+    word_keywords = [k for k in keyword_map if k not in substring_keywords]
+    # One lookahead per start position, so overlapping keywords are all seen in a single scan
+    keyword_re = re.compile(r"(?=\b(" + _trie_pattern(word_keywords) + r")\b)") if word_keywords else None
+    return InstrumentVocabulary(types.MappingProxyType(dict(keyword_map)),
+                                types.MappingProxyType({k: rank for rank, k in enumerate(ranked)}),
+                                substring_keywords, keyword_re)
+
+
+def compile_rules(config, path=None):
+    """Validate a rules document (the parsed JSON) and compile it into a RulePlan."""
+    try:
+        jsonschema.validate(config, RULES_SCHEMA)
+    except jsonschema.ValidationError as e:
+        location = "/".join(str(p) for p in e.absolute_path) or "(top level)"
+        raise RulesConfigError(f"{path or 'rules'}: {location}: {e.message}") from None
+
+    instruments = config['instruments']
+    unknown = [k for k in instruments['substring_keywords'] if k not in instruments['keywords']]
+    if unknown:
+        raise RulesConfigError(f"{path or 'rules'}: instruments/substring_keywords: not in keywords: {unknown}")
+
+    cols = config['columns']
+    columns = ColumnRoles(*(excel_col_to_index(cols[role]) for role in SINGLE_COLUMN_ROLES),
+                          tuple(excel_col_to_index(c) for c in cols['row_numbers']))
+    excluded_cols = tuple(sorted({excel_col_to_index(c) for c in config['excluded_columns']}))
+
+    vocal = config['vocal_rules']
+    lyrics, flag, description = vocal['lyrics'], vocal['vocal_flag'], vocal['vocal_description']
+    vocal_rules = VocalRules(
+        vocal['stem_keyword'].lower(), lyrics['vocal'], lyrics['non_vocal'],
+        re.compile(r'\b' + re.escape(lyrics['rewrite_word']) + r'\b', re.IGNORECASE), lyrics['rewrite_word'],
+        lyrics['rewrite_replacement'], flag['vocal'], flag['non_vocal'], description['non_vocal'],
+        frozenset(description['background_stems']), description['background'],
+        tuple(excel_col_to_index(c) for c in vocal['copy_from_source_when_vocal']))
+
+    # The version covers everything that changes outputs: the rule document and the engine revision
+    version = hashlib.sha256(json.dumps([ENGINE_REVISION, {k: v for k, v in config.items() if k != 'name'}],
+                                        sort_keys=True).encode()).hexdigest()[:16]
+    return RulePlan(
+        version, config.get('name', ""), path, columns, excluded_cols,
+        frozenset(excluded_cols) | {columns.track_title},
+        tuple((excel_col_to_index(c), v) for c, v in config['stem_constant_fills'].items()),
+        vocal_rules, _compile_instruments(instruments))
+
+
+@functools.lru_cache(maxsize=None)
+def load_rule_plan(path=DEFAULT_RULES_PATH):
+    try:
+        with open(path, encoding='utf-8') as f: config = json.load(f)
+    except OSError as e:
+        raise RulesConfigError(f"Cannot read rules file {path}: {e.strerror}") from None
+    except json.JSONDecodeError as e:
+        raise RulesConfigError(f"{path} is not valid JSON: {e}") from None
+    return compile_rules(config, path)
+
+
+def active_rules_path():
+    return os.environ.get(RULES_PATH_ENV) or DEFAULT_RULES_PATH
+
+
+def active_rule_plan():
+    """The plan every transform in this process uses (XL_MASTER_RULES, else rules.json)."""
+    return load_rule_plan(os.path.abspath(active_rules_path()))
@@ -0,0 +1,80 @@
+import os
+import time
+import uuid
+import shutil
+import zipfile
+import urllib.parse
+
+# Processed workbooks are spilled to disk as soon as they finish instead of accumulating in
+# server RAM. The spool lives under ./static so Streamlit's static file server (enabled in
+# .streamlit/config.toml) can stream downloads straight from disk.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, 'static')
+SPOOL_ROOT = os.path.join(STATIC_DIR, 'spool')
+SPOOL_MAX_AGE_SECONDS = 6 * 60 * 60
+# Streamlit refuses to serve static files above 200 MB; outputs larger than that (or any output
+# when static serving is off) are not offered for download, since every other route buffers the
+# whole file in server memory. Zips of many outputs are split into parts below the limit.
+STATIC_SERVING_MAX_BYTES = 200 * 1024 * 1024
+# Room for zip headers and deflate's worst case on already-compressed workbooks
+ZIP_PART_OVERHEAD_BYTES = 4 * 1024 * 1024
+
+
+def prune_spool(root=SPOOL_ROOT, max_age_seconds=SPOOL_MAX_AGE_SECONDS):
+    if not os.path.isdir(root): return
+    cutoff = time.time() - max_age_seconds
+    for entry in os.scandir(root):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass  # already removed by another session
+
+
+class OutputSpool:
+    """One batch's outputs on disk, in the order they were added."""
+
+    def __init__(self, root=SPOOL_ROOT):
+        prune_spool(root)
+        self.batch_id = uuid.uuid4().hex
+        self.dir = os.path.join(root, self.batch_id)
+        os.makedirs(self.dir)
+        self.entries = []  # (download name, path)
+
+    def add(self, name, data):
+        # Index prefix keeps same-named uploads from overwriting each other
+        path = os.path.join(self.dir, f"{len(self.entries):04d}-{os.path.basename(name)}")
+        with open(path, 'wb') as f: f.write(data)
+        self.entries.append((name, path))
+        return path
+
+    def build_zip(self, zip_name, entries=None):
+        # zipfile.write() copies each spooled file in chunks, so the zip never sits in memory
+        path = os.path.join(self.dir, zip_name)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, entry_path in self.entries if entries is None else entries: zf.write(entry_path, arcname=name)
+        return path
+
+    def build_zip_parts(self, zip_stem, max_bytes=STATIC_SERVING_MAX_BYTES):
+        """[(zip name, path)]: one zip, or consecutive parts each holding at most max_bytes of outputs.
+
+        An output larger than max_bytes on its own still gets a part, which is too large to serve."""
+        budget, groups, group_bytes = max_bytes - ZIP_PART_OVERHEAD_BYTES, [[]], 0
+        for name, entry_path in self.entries:
+            size = os.path.getsize(entry_path)
+            if groups[-1] and group_bytes + size > budget:
+                groups.append([]); group_bytes = 0
+            groups[-1].append((name, entry_path)); group_bytes += size
+        if len(groups) == 1: return [(f"{zip_stem}.zip", self.build_zip(f"{zip_stem}.zip"))]
+        zip_names = [f"{zip_stem}_part{k + 1}of{len(groups)}.zip" for k in range(len(groups))]
+        return [(zip_name, self.build_zip(zip_name, group)) for zip_name, group in zip(zip_names, groups)]
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def static_url(path):
+    # Relative URL Streamlit's static file server uses for a file under ./static
+    rel_path = os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')
+    return "app/static/" + urllib.parse.quote(rel_path)
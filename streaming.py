@@ -0,0 +1,274 @@
+import io
+import itertools
+import zipfile
+import collections
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+from openpyxl.styles import Alignment, Border, Font, Side
+import numpy as np
+from pandas._libs import lib
+from pandas._libs.parsers import STR_NA_VALUES
+from pandas.io.parsers import TextParser
+
+from processing import (DIFF_CELL_LIMIT, build_lookup_maps, cell_changes, count_filename_rows, header_text_lengths,
+                        max_text_lengths, merge_lookup_maps, transform_chunk, widths_from_lengths)
+
+# Constant-memory path for very large workbooks. A light first pass builds the sheet-wide
+# lookup maps, then rows are streamed from a read-only workbook through transform_chunk()
+# into a write-only workbook, so peak memory follows the maps and one chunk, not the sheet.
+# Cells are converted exactly as pd.read_excel converts them, including its type inference over
+# whole columns (see "Sheet-wide Column Types").
+# Column widths are tracked per chunk and spliced into the sheet XML after saving, because a
+# write-only sheet emits its <cols> element before the first row.
+
+STREAMING_ROW_THRESHOLD = 100_000
+STREAMING_CHUNK_ROWS = 5_000
+
+# witnesses holds, per column, one cell value of every kind the column contains (see _value_class)
+StreamScan = collections.namedtuple('StreamScan', ['columns', 'n_rows', 'lookup_maps', 'witnesses'])
+
+# Matches the header style pandas' to_excel applies
+_thin = Side(style='thin')
+_HEADER_FONT = Font(bold=True)
+_HEADER_BORDER = Border(left=_thin, right=_thin, top=_thin, bottom=_thin)
+_HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+
+
+def _convert_cell(cell):
+    # Same conversion as pandas' openpyxl reader
+    if cell.value is None: return ""
+    if cell.data_type == TYPE_ERROR: return np.nan
+    if cell.data_type == TYPE_NUMERIC:
+        val = int(cell.value)
+        return val if val == cell.value else float(cell.value)
+    return cell.value
+
+
+def _iter_sheet_rows(data):
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        for row in ws.rows:
+            converted_row = [_convert_cell(cell) for cell in row]
+            while converted_row and converted_row[-1] == "": converted_row.pop()
+            yield converted_row
+    finally:
+        wb.close()
+
+
+def _iter_chunks(rows, chunk_rows):
+    while True:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if not chunk: return
+        yield chunk
+
+
+# --- Sheet-wide Column Types ---
+# read_excel infers each column's type from all of its cells: 7 next to a blank anywhere in the
+# sheet is 7.0, and '0' stays text if the column holds 'x' somewhere. A chunk parsed on its own
+# would infer from its own rows. That inference only depends on which kinds of values a column
+# holds, so the scan keeps one value of each kind per column (its witnesses), and every chunk is
+# parsed with a row of witnesses appended: it then infers exactly what the whole sheet does.
+_BOOL_TEXT = frozenset(['True', 'TRUE', 'true', 'False', 'FALSE', 'false'])
+
+
+def _value_class(value):
+    # What one cell contributes to the inference (mirrors pandas' _infer_types: numeric, then bool)
+    if isinstance(value, bool): return ('bool',)
+    if isinstance(value, int): return ('int', value < 0, value.bit_length() > 63, value.bit_length() > 64)
+    if isinstance(value, float): return ('float', value != value)
+    if not isinstance(value, str): return (type(value).__name__,)
+    if value in STR_NA_VALUES: return ('na',)
+    try:
+        converted, _ = lib.maybe_convert_numeric(np.array([value], dtype=object), STR_NA_VALUES, False)
+    except (ValueError, TypeError):
+        return ('text', value in _BOOL_TEXT)
+    return ('numeric text', converted.dtype.str, bool(converted[0] < 0))
+
+
+_PLAIN_TEXT = ('text', False)  # a column holding this is text whatever else it holds
+
+
+def _collect_value_classes(classes, rows, width):
+    for ci in range(width):
+        seen = classes.setdefault(ci, {})
+        if _PLAIN_TEXT in seen: continue
+        # Keyed by type too: 1, 1.0 and True are equal as dict keys but not to the inference
+        for value in {(type(v), v): v for v in (row[ci] if ci < len(row) else "" for row in rows)}.values():
+            seen.setdefault(_value_class(value), value)
+
+
+def _chunk_frame(chunk, width, names=None, witnesses=()):
+    padded = [row + [""] * (width - len(row)) for row in chunk]
+    n_witness_rows = max(map(len, witnesses), default=0)
+    # Witness row j repeats a column's last witness once it runs out, which adds no new kind
+    padded += [[w[min(j, len(w) - 1)] if w else "" for w in witnesses] + [""] * (width - len(witnesses))
+               for j in range(n_witness_rows)]
+    df = TextParser(padded, header=None, names=names if names is not None else list(range(width)),
+                    skip_blank_lines=False).read()
+    return df.iloc[:len(chunk)] if n_witness_rows else df
+
+
+def _raw_chunk_frame(chunk, width):
+    # Cells as read, blanks as NaN: the scan can't infer types before it has seen every row
+    padded = [row + [""] * (width - len(row)) for row in chunk]
+    return TextParser(padded, header=None, names=list(range(width)), dtype=object, skip_blank_lines=False).read()
+
+
+def estimate_row_count(data):
+    # Row count from the sheet's dimension record; None when the writer didn't store one
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, keep_links=False)
+    try:
+        max_row = wb.worksheets[0].max_row
+        return max_row - 1 if max_row else None
+    finally:
+        wb.close()
+
+
+def scan_workbook(data, chunk_rows=STREAMING_CHUNK_ROWS, progress=None):
+    """First pass: header, data row count (trailing blank rows dropped), lookup maps and column witnesses.
+
+    progress(rows_scanned) is called after every chunk; an exception it raises aborts the scan.
+    """
+    rows = _iter_sheet_rows(data)
+    header = next(rows, None)
+    if header is None:
+        return StreamScan([], 0, ({}, {}), ())
+    width, n_rows, last_row_with_data = len(header), 0, 0
+    lookup_maps, classes = ({}, {}), {}
+    # Blank rows only count once data follows them (read_excel drops trailing ones); narrowest is
+    # the width of the narrowest chunk, whose rows are blank in every column beyond it
+    blank_rows_pending = blank_rows_inside = False
+    narrowest = None
+    for chunk in _iter_chunks(rows, chunk_rows):
+        data_rows = 0
+        for k, row in enumerate(chunk, start=1):
+            n_rows += 1
+            if row:
+                last_row_with_data, data_rows = n_rows, k
+                width = max(width, len(row))
+        if data_rows:
+            blank_rows_inside |= blank_rows_pending
+            chunk, blank_rows_pending = chunk[:data_rows], data_rows < len(chunk)
+            chunk_width = max(len(header), max(len(row) for row in chunk))
+            narrowest = chunk_width if narrowest is None else min(narrowest, chunk_width)
+            _collect_value_classes(classes, chunk, chunk_width)
+            # Title keys and source rows as read; retyped below once the witnesses are complete
+            merge_lookup_maps(lookup_maps, build_lookup_maps(_raw_chunk_frame(chunk, chunk_width)))
+        else:
+            blank_rows_pending = True
+        if progress: progress(n_rows)
+    for ci in range(width):
+        if blank_rows_inside or narrowest is None or ci >= narrowest:
+            classes.setdefault(ci, {}).setdefault(('na',), "")
+    witnesses = tuple(tuple(classes[ci].values()) for ci in range(width))
+    columns = TextParser([header + [""] * (width - len(header))], header=0).read().columns.tolist()
+    # Source rows get the sheet's types (and its full width); a title may change with them (7 -> '7.0').
+    # The track numbers come from filenames, which are text in any column that has them
+    source_rows = [list(row) for row in lookup_maps[0].values()]
+    source_map = build_lookup_maps(_chunk_frame(source_rows, width, witnesses=witnesses))[0] if source_rows else {}
+    return StreamScan(columns, last_row_with_data, (source_map, lookup_maps[1]), witnesses)
+
+
+def _insert_column_widths(xlsx_bytes, widths, sheet_path='xl/worksheets/sheet1.xml'):
+    cols_xml = "<cols>" + "".join(f'<col min="{i}" max="{i}" width="{w}" customWidth="1"/>'
+                                  for i, w in enumerate(widths, start=1)) + "</cols>"
+    output_buffer = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(xlsx_bytes)) as zin, \
+            zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            if item.filename != sheet_path:
+                zout.writestr(item, zin.read(item.filename)); continue
+            with zin.open(item) as src, zout.open(item.filename, 'w') as dst:
+                head = b""
+                while b"<sheetData" not in head:
+                    block = src.read(64 * 1024)
+                    if not block: break
+                    head += block
+                dst.write(head.replace(b"<sheetData", cols_xml.encode() + b"<sheetData", 1))
+                while True:
+                    block = src.read(1024 * 1024)
+                    if not block: break
+                    dst.write(block)
+    return output_buffer.getvalue()
+
+
+def _open_output_sheet(columns):
+    wb_out = openpyxl.Workbook(write_only=True)
+    ws_out = wb_out.create_sheet('Sheet1')
+    header_cells = []
+    for name in columns:
+        cell = WriteOnlyCell(ws_out, value=name)
+        cell.font, cell.border, cell.alignment = _HEADER_FONT, _HEADER_BORDER, _HEADER_ALIGNMENT
+        header_cells.append(cell)
+    ws_out.append(header_cells)
+    return wb_out, ws_out
+
+
+def _append_frame(ws_out, df):
+    for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+        ws_out.append(row)
+
+
+def _copy_unchanged_rows(ws_out, data, scan, n_rows, chunk_rows):
+    # Re-reads the first n_rows data rows (whole chunks that transform_chunk left as they were)
+    rows = _iter_sheet_rows(data)
+    try:
+        next(rows, None)
+        for chunk in _iter_chunks(itertools.islice(rows, n_rows), chunk_rows):
+            _append_frame(ws_out, _chunk_frame(chunk, len(scan.columns), scan.columns, scan.witnesses))
+    finally:
+        rows.close()
+
+
+def stream_transform_workbook(data, scan, chunk_rows=STREAMING_CHUNK_ROWS, fit_widths=True, edits=None,
+                              progress=None, diff=None):
+    """Second pass. Returns (output_bytes, file_was_modified); output_bytes is None if nothing changed.
+
+    Nothing is written before the first chunk that changes a cell; the rows above it are then
+    re-read and copied, so a sheet that is already processed costs a read and no write.
+    If edits is a list, (row_positions, col_idx) pairs are appended as in transform_dataframe;
+    if diff is a list, the first DIFF_CELL_LIMIT processing.CellChanges are appended.
+    progress(fraction) is called after every chunk; an exception it raises aborts the pass.
+    """
+    wb_out = ws_out = None
+    text_lengths = header_text_lengths(scan.columns)
+    rows = _iter_sheet_rows(data)
+    try:
+        next(rows, None)  # header
+        remaining, counter_offset = scan.n_rows, 0
+        for chunk in _iter_chunks(rows, chunk_rows):
+            chunk = chunk[:remaining]
+            first_row = scan.n_rows - remaining
+            remaining -= len(chunk)
+            if not chunk: break
+            df_chunk = _chunk_frame(chunk, len(scan.columns), scan.columns, scan.witnesses)
+            chunk_edits = []
+            df_processed, chunk_modified = transform_chunk(df_chunk, scan.lookup_maps, counter_offset,
+                                                           edits=chunk_edits)
+            if edits is not None: edits.extend((np.asarray(positions) + first_row, ci) for positions, ci in chunk_edits)
+            if diff is not None and len(diff) < DIFF_CELL_LIMIT:
+                diff.extend(cell_changes(df_chunk, df_processed, chunk_edits, DIFF_CELL_LIMIT - len(diff), first_row))
+            counter_offset += count_filename_rows(df_chunk)
+            if fit_widths: text_lengths = list(map(max, text_lengths, max_text_lengths(df_processed)))
+            if chunk_modified and ws_out is None:
+                wb_out, ws_out = _open_output_sheet(scan.columns)
+                if first_row: _copy_unchanged_rows(ws_out, data, scan, first_row, chunk_rows)
+            if ws_out is not None: _append_frame(ws_out, df_processed)
+            if progress: progress((scan.n_rows - remaining) / scan.n_rows)
+            if remaining <= 0: break
+    except BaseException:
+        if ws_out is not None: ws_out.close()  # finish the half-written sheet so its temp file is released
+        raise
+    finally:
+        rows.close()
+
+    if wb_out is None: return None, False
+    output_buffer = io.BytesIO()
+    wb_out.save(output_buffer)
+    if fit_widths and text_lengths:
+        return _insert_column_widths(output_buffer.getvalue(), widths_from_lengths(text_lengths)), True
+    return output_buffer.getvalue(), True
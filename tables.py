@@ -0,0 +1,67 @@
+import io
+import os
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from processing import is_arrow_column
+
+# Parquet and CSV in and out, for pipelines that export cue sheets from a database and load
+# them back. Columns are matched by position, exactly like a sheet, so the letter-based rules
+# apply unchanged; the first CSV line is the header. Cells read as pd.read_excel would give
+# them where the format allows: empty CSV fields and Parquet nulls are blank cells, and CSV
+# fields stay text (a track number "01" must not become 1.0).
+
+TABLE_EXTENSIONS = ('.parquet', '.csv')
+OUTPUT_FORMATS = ('xlsx', 'parquet', 'csv')
+OUTPUT_MIME_TYPES = {'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                     'parquet': "application/vnd.apache.parquet", 'csv': "text/csv"}
+
+
+def is_table_file(name):
+    return name.lower().endswith(TABLE_EXTENSIONS)
+
+
+def output_name(name, output_format):
+    # Excel uploads keep their name (as they always have); anything else gets the format's extension
+    stem, ext = os.path.splitext(name)
+    if output_format == 'xlsx' and ext.lower() in ('.xlsx', '.xls'): return name
+    return f"{stem}.{output_format}"
+
+
+def read_table_bytes(name, data):
+    if name.lower().endswith('.parquet'):
+        table = pq.read_table(io.BytesIO(data))
+    else:
+        # Only empty fields are blank: text such as "NA" or "nan" stays text, as it would in a sheet
+        names = pa_csv.open_csv(io.BytesIO(data)).schema.names
+        table = pa_csv.read_csv(io.BytesIO(data), convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in names}, null_values=[""], strings_can_be_null=True))
+    # A stored pandas index would come back as the frame's index; rows are positional here
+    return table.to_pandas().reset_index(drop=True)
+
+
+def _arrow_column(series):
+    if is_arrow_column(series): return pa.array(series)
+    try:
+        return pa.array(series, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Text and numbers in one column (common in sheets): Arrow columns have one type, so all text
+        return pa.array(series.map(str, na_action='ignore'), from_pandas=True)
+
+
+def arrow_table(df):
+    return pa.Table.from_arrays([_arrow_column(df.iloc[:, ci]) for ci in range(df.shape[1])],
+                                names=[str(name) for name in df.columns])
+
+
+def write_table_bytes(df, output_format):
+    sink = pa.BufferOutputStream()
+    if output_format == 'parquet':
+        pq.write_table(arrow_table(df), sink)
+    elif output_format == 'csv':
+        pa_csv.write_csv(arrow_table(df), sink)
+    else:
+        raise ValueError(f"unknown table format {output_format!r}")
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import datetime
+
+from batch import DEFAULT_MAX_WORKERS, process_path, run_batch
+from cache import settings_key
+from cli import add_processing_arguments, collect_input_files, options_from_args
+from tables import output_name
+
+# Long-running ingestion: polls an input directory and processes new or changed workbooks into
+# an output directory (same relative paths).
+#   python watch.py incoming/ -o processed/ -j 4 --settle 10
+# A manifest (JSON, written after every file) records each input's size, mtime, content hash and
+# the settings key (rule version + output options) it was processed with, so a restart skips
+# everything already done: unchanged size/mtime is trusted without hashing, a touched file with
+# the same hash is skipped too. Files must keep the same size and mtime for settle_seconds before
+# they are picked up, which debounces copies still in progress.
+
+MANIFEST_NAME = '.xl_master_manifest.json'
+MANIFEST_VERSION = 1
+DEFAULT_POLL_SECONDS = 2.0
+DEFAULT_SETTLE_SECONDS = 5.0
+# Files handed to one run_batch call; the rest wait for the next poll so new arrivals aren't starved
+MAX_FILES_PER_ROUND = 64
+# Polls in a row a file may stay unreadable (locked, no permission) under --once before it counts as an error
+ONCE_MAX_READ_ATTEMPTS = 3
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""): digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f: manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"{path} is not a version {MANIFEST_VERSION} manifest")
+    return manifest['files']
+
+
+def save_manifest(path, entries):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f: json.dump({'version': MANIFEST_VERSION, 'files': entries}, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _log(message):
+    print(f"{datetime.datetime.now().isoformat(timespec='seconds')} {message}", file=sys.stderr, flush=True)
+
+
+class FolderWatcher:
+    def __init__(self, input_dir, output_dir, options, manifest_path=None, max_workers=DEFAULT_MAX_WORKERS,
+                 settle_seconds=DEFAULT_SETTLE_SECONDS, recursive=False):
+        self.input_dir = os.path.abspath(input_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.options = options
+        self.settings = settings_key(options)
+        self.manifest_path = manifest_path or os.path.join(self.output_dir, MANIFEST_NAME)
+        self.max_workers = max_workers
+        self.settle_seconds = settle_seconds
+        self.recursive = recursive
+        self.entries = load_manifest(self.manifest_path)
+        self._seen = {}  # rel path -> (size, mtime_ns, time first seen with that stat, time first seen at all)
+        self._read_failures = {}  # rel path -> polls in a row its contents couldn't be read
+        self.error_count = 0  # files recorded as errors since this watcher started
+
+    def _input_paths(self):
+        output_prefix = self.output_dir + os.sep
+        return [p for p in collect_input_files([self.input_dir], self.recursive) if not p.startswith(output_prefix)]
+
+    def poll(self, max_read_attempts=None):
+        """Inputs that are new or changed and have settled: [(rel path, path, stat, sha256, arrival time)].
+
+        A file still unreadable after max_read_attempts polls is recorded as an error (None: retried forever)."""
+        now, ready, seen = time.time(), [], {}
+        for path in self._input_paths():
+            rel = os.path.relpath(path, self.input_dir)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # removed between listing and stat
+            entry = self.entries.get(rel)
+            # Files recorded as unreadable (no hash) are tried again on the next run
+            if entry and entry['sha256'] and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns \
+                    and entry['settings'] == self.settings:
+                continue
+            previous = self._seen.get(rel)
+            stable_since = previous[2] if previous and previous[:2] == (stat.st_size, stat.st_mtime_ns) else now
+            arrived = previous[3] if previous else now
+            seen[rel] = (stat.st_size, stat.st_mtime_ns, stable_since, arrived)
+            # Settled once its stat held still for settle_seconds (or it was last written that long ago)
+            if now - stable_since < self.settle_seconds and now - stat.st_mtime < self.settle_seconds: continue
+            try:
+                digest = file_sha256(path)
+            except OSError as e:
+                failures = self._read_failures[rel] = self._read_failures.get(rel, 0) + 1
+                if max_read_attempts and failures >= max_read_attempts:
+                    del self._read_failures[rel], seen[rel]
+                    self._record_unreadable(rel, stat, arrived, e)
+                continue
+            self._read_failures.pop(rel, None)
+            if entry and entry['sha256'] == digest and entry['settings'] == self.settings:
+                entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)  # touched, not changed
+                save_manifest(self.manifest_path, self.entries)
+                continue
+            ready.append((rel, path, stat, digest, arrived))
+        self._seen = seen
+        return ready
+
+    @property
+    def unsettled(self):
+        # Files the last poll found new or changed, whether or not they were ready
+        return len(self._seen)
+
+    def process(self, ready):
+        """Run ready files through the bounded process pool; outputs and manifest are written per file."""
+        ready = {rel: item for rel, *item in ready[:MAX_FILES_PER_ROUND]}
+
+        def handle_result(done_count, result):
+            self._record(result, *ready.pop(result.name))
+
+        # Keyed by relative path: the same file name can turn up in several subdirectories
+        return run_batch([(rel, path, self.options) for rel, (path, *_) in ready.items()], self.max_workers,
+                         handle_result, worker=process_watched_file, keep_outputs=False)
+
+    def _record_unreadable(self, rel, stat, arrived, error):
+        self.error_count += 1
+        _log(f"error: {rel} could not be read: {error}")
+        self.entries[rel] = {
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': None, 'settings': self.settings,
+            'status': 'error', 'output': None, 'changed_cells': 0, 'message': f"Can't read {rel}: {error}",
+            'seconds': 0.0, 'latency_seconds': round(time.time() - arrived, 3),
+            'processed_at': datetime.datetime.now().isoformat(timespec='seconds')}
+        save_manifest(self.manifest_path, self.entries)
+
+    def _record(self, result, path, stat, digest, arrived):
+        rel = result.name
+        output = None
+        if result.status == 'error': self.error_count += 1
+        if result.status == 'processed':
+            output = os.path.join(self.output_dir, output_name(rel, self.options.output_format))
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            tmp_output = f"{output}.{os.getpid()}.tmp"
+            with open(tmp_output, 'wb') as f: f.write(result.output)
+            os.replace(tmp_output, output)  # consumers of the output directory never see half a file
+        latency = time.time() - arrived
+        seconds = sum(record.seconds for record in result.metrics.phases) if result.metrics else 0.0
+        rows, rate = result.shape[0], 1 / seconds if seconds else 0.0
+        _log(f"{result.status}: {rel} ({rows} rows, {result.changed_cells} changed cells) in {seconds:.2f}s "
+             f"= {rows * rate:,.0f} rows/s, {stat.st_size / 2 ** 20 * rate:.2f} MB/s; {latency:.1f}s after arrival"
+             + (f" - {result.message}" if result.message else ""))
+        try:
+            current = os.stat(path)
+        except OSError:
+            return
+        if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return  # rewritten while it was processed; the next poll picks it up again
+        self.entries[rel] = {
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest, 'settings': self.settings,
+            'status': result.status, 'output': output, 'changed_cells': result.changed_cells, 'message': result.message,
+            'seconds': round(seconds, 3), 'latency_seconds': round(latency, 3),
+            'processed_at': datetime.datetime.now().isoformat(timespec='seconds')}
+        save_manifest(self.manifest_path, self.entries)
+
+    def run(self, poll_seconds=DEFAULT_POLL_SECONDS, once=False):
+        """Poll and process until interrupted; with once=True, stop when nothing is left to settle
+        (files that stay unreadable are given up on after ONCE_MAX_READ_ATTEMPTS polls)."""
+        while True:
+            self.process(self.poll(ONCE_MAX_READ_ATTEMPTS if once else None))
+            if once and not self.unsettled: return
+            time.sleep(poll_seconds)
+
+
+def process_watched_file(rel, path, options, progress=None):
+    # process_path under the relative path, so results can be told apart across subdirectories
+    return process_path(path, options, progress)._replace(name=rel)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Watch a directory and process new or changed cue sheets.")
+    parser.add_argument('input_dir', help="Directory to watch")
+    parser.add_argument('-o', '--output-dir', required=True, help="Directory for processed workbooks")
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f"Worker processes (default: {DEFAULT_MAX_WORKERS})")
+    parser.add_argument('-r', '--recursive', action='store_true', help="Also watch subdirectories")
+    parser.add_argument('--manifest', metavar='PATH', help=f"Manifest file (default: OUTPUT_DIR/{MANIFEST_NAME})")
+    parser.add_argument('--poll', type=float, default=DEFAULT_POLL_SECONDS,
+                        help=f"Seconds between directory scans (default: {DEFAULT_POLL_SECONDS:g})")
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help="Seconds a file's size and mtime must hold still before it is processed "
+                             f"(default: {DEFAULT_SETTLE_SECONDS:g})")
+    parser.add_argument('--once', action='store_true', help="Process what is there, then exit")
+    add_processing_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    os.makedirs(args.output_dir, exist_ok=True)
+    watcher = FolderWatcher(args.input_dir, args.output_dir, options_from_args(args), args.manifest, args.workers,
+                            args.settle, args.recursive)
+    _log(f"watching {watcher.input_dir} -> {watcher.output_dir} ({len(watcher.entries)} file(s) in the manifest)")
+    try:
+        watcher.run(args.poll, args.once)
+    except KeyboardInterrupt:
+        _log("stopped")
+    # --once is a batch run: like cli.py, exit status 1 if any file errored
+    return 1 if args.once and watcher.error_count else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())